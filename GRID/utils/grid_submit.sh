@@ -31,8 +31,9 @@ notify_mattermost() {
   set +x
   if [ "$MATTERMOSTHOOK" ]; then
     text=$1
-    COMMAND="curl -X POST -H 'Content-type: application/json' --data '{\"text\":\""${text}"\"}' "${MATTERMOSTHOOK}" &> /dev/null"
-    eval "${COMMAND}"  
+    COMMAND="curl --max-time 10 -X POST -H 'Content-type: application/json' --data '{\"text\":\""${text}"\"}' "${MATTERMOSTHOOK}" &> /dev/null"
+    # in the background (and time limited) so that a slow or unreachable hook never delays the job
+    ( eval "${COMMAND}" & )
   fi
 }
 
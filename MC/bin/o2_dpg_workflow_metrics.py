@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+# Analysis of the metric stream (pipeline_metric.log) written by o2_dpg_workflow_runner.py.
+#
+# The metric log holds one json object per line, each with a 'time' field:
+#   {'type':'task_start', 'name', 'label', 'cpu', 'mem', 'nice'}  declared resources at submission
+#   {'name', 'iter', 'cpu', 'pss', 'uss', 'swap', 'nice', 'label'}  resource sample of a running task
+#   {'type':'task_end', 'name', 'returncode', 'duration'}           end of a task
+#   {'type':'task_retry', 'name', 'attempt', 'returncode', 'reason', 'delay'}  failed attempt which is retried
+# (plus records of the monitor itself and of memory pressure actions).
+#
+# Aggregated per task and per label are: peak PSS (MB), CPU time (core seconds), duration (s),
+# CPU efficiency (CPU time / (declared cores x duration)) and memory efficiency (peak PSS /
+# declared memory). The file is streamed line by line; orjson is used if available.
+
+import argparse
+import json
+import sys
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+class TaskMetrics:
+    __slots__ = ('name', 'labels', 'declaredcpu', 'declaredmem', 'start', 'end', 'lastsample', 'peakpss', 'cputime', 'returncode', 'duration', 'retries')
+
+    def __init__(self, name):
+        self.name = name
+        self.labels = []
+        self.declaredcpu = None
+        self.declaredmem = None
+        self.start = None
+        self.end = None
+        self.lastsample = None
+        self.peakpss = 0.
+        self.cputime = 0.
+        self.returncode = None
+        self.duration = None
+        self.retries = 0
+
+    def wall(self):
+        if self.duration != None:
+            return self.duration
+        if self.start != None and self.lastsample != None:
+            return self.lastsample - self.start
+        return None
+
+def analyse(filename):
+    tasks = {}
+    monitorcost = 0.
+    nsamples = 0
+    with open(filename, 'rb') as fp:
+        for line in fp:
+            if not line.startswith(b'{'):
+                continue # not produced by the structured metric stream
+            try:
+                r = loads(line)
+            except ValueError:
+                continue
+            name = r.get('name')
+            if name == None:
+                continue
+            if name == '__monitor__':
+                monitorcost += r.get('sampler_cpu', 0.)
+                continue
+            t = tasks.get(name)
+            if t == None:
+                t = tasks[name] = TaskMetrics(name)
+            rtype = r.get('type')
+            if rtype == 'task_start':
+                t.start = r['time']
+                t.labels = r.get('label', [])
+                t.declaredcpu = r.get('cpu')
+                t.declaredmem = r.get('mem')
+            elif rtype == 'task_retry':
+                t.retries += 1
+            elif rtype == 'task_end':
+                t.end = r['time']
+                t.returncode = r.get('returncode')
+                t.duration = r.get('duration')
+            elif 'pss' in r and not 'action' in r:
+                nsamples += 1
+                now = r['time']
+                # cpu (percent of a core) integrated over the time since the previous sample
+                previous = t.lastsample if t.lastsample != None else t.start
+                if previous != None and now > previous:
+                    t.cputime += r['cpu']/100. * (now - previous)
+                t.lastsample = now
+                t.peakpss = max(t.peakpss, r['pss'])
+                if len(t.labels) == 0:
+                    t.labels = r.get('label', [])
+    return tasks, monitorcost, nsamples
+
+def efficiencies(cputime, peakpss, wall, declaredcpu, declaredmem):
+    cpueff = None
+    memeff = None
+    if declaredcpu != None and wall != None and float(declaredcpu) > 0 and wall > 0:
+        cpueff = cputime / (float(declaredcpu) * wall)
+    if declaredmem != None and float(declaredmem) > 0:
+        memeff = peakpss / float(declaredmem)
+    return cpueff, memeff
+
+def task_table(tasks):
+    rows = []
+    for t in tasks.values():
+        wall = t.wall()
+        cpueff, memeff = efficiencies(t.cputime, t.peakpss, wall, t.declaredcpu, t.declaredmem)
+        rows.append({ 'name':t.name, 'labels':t.labels, 'peak_pss':t.peakpss, 'cpu_seconds':t.cputime, 'duration':wall,
+                      'declared_cpu':t.declaredcpu, 'declared_mem':t.declaredmem, 'cpu_efficiency':cpueff, 'mem_efficiency':memeff,
+                      'returncode':t.returncode, 'retries':t.retries })
+    return rows
+
+def label_table(tasks):
+    labels = {}
+    for t in tasks.values():
+        for l in t.labels:
+            a = labels.get(l)
+            if a == None:
+                a = labels[l] = { 'label':l, 'ntasks':0, 'peak_pss':0., 'cpu_seconds':0., 'duration':0., 'booked_core_seconds':0., 'mem_efficiency':None }
+            wall = t.wall() or 0.
+            a['ntasks'] += 1
+            a['peak_pss'] = max(a['peak_pss'], t.peakpss)
+            a['cpu_seconds'] += t.cputime
+            a['duration'] += wall
+            if t.declaredcpu != None and float(t.declaredcpu) > 0:
+                a['booked_core_seconds'] += float(t.declaredcpu) * wall
+            _, memeff = efficiencies(t.cputime, t.peakpss, wall, t.declaredcpu, t.declaredmem)
+            if memeff != None:
+                a['mem_efficiency'] = max(a['mem_efficiency'] or 0., memeff)
+    for a in labels.values():
+        a['cpu_efficiency'] = a['cpu_seconds'] / a['booked_core_seconds'] if a['booked_core_seconds'] > 0 else None
+    return list(labels.values())
+
+def fmt(value, f='%10.2f'):
+    return f % value if value != None else ' ' * (len(f % 0.) - 1) + '-'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Aggregates the metric stream of the O2DPG workflow runner per task and per label.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('metricfile', nargs='?', help='Metric file written by the runner.', default='pipeline_metric.log')
+    parser.add_argument('--by', choices=['task', 'label'], help='Aggregation level.', default='task')
+    parser.add_argument('--sort', choices=['name', 'peak_pss', 'cpu_seconds', 'duration', 'cpu_efficiency', 'mem_efficiency'],
+                        help='Column to sort by (descending for numbers).', default='name')
+    parser.add_argument('--json', action='store_true', help='Print the result as json.')
+    args = parser.parse_args()
+
+    tasks, monitorcost, nsamples = analyse(args.metricfile)
+    rows = task_table(tasks) if args.by == 'task' else label_table(tasks)
+    key = 'name' if args.by == 'task' else 'label'
+    if args.sort == 'name':
+        rows.sort(key=lambda r : r[key])
+    else:
+        rows.sort(key=lambda r : r[args.sort] if r[args.sort] != None else -1., reverse=True)
+
+    if args.json:
+        json.dump(rows, sys.stdout, indent=1)
+        print ()
+        sys.exit (0)
+
+    print ('%-30s' % key + '  peakPSS[MB]  CPU[core s]  duration[s]  CPU eff.  MEM eff.')
+    for r in rows:
+        print ('%-30s' % r[key] + fmt(r['peak_pss'], '%13.1f') + fmt(r['cpu_seconds'], '%13.1f') + fmt(r['duration'], '%13.1f')
+               + fmt(r['cpu_efficiency'], '%10.2f') + fmt(r['mem_efficiency'], '%10.2f'))
+    print ('\n' + str(len(tasks)) + ' tasks, ' + str(nsamples) + ' samples, monitoring cost ' + '%.2f' % monitorcost + ' CPU s')
@@ -3,6 +3,7 @@
 # started February 2021, sandro.wenzel@cern.ch
 
 import re
+import select
 import subprocess
 import shlex
 import time
@@ -12,6 +13,20 @@ import os
 import signal
 import sys
 import traceback
+import mmap
+import pickle
+import hashlib
+import sqlite3
+import threading
+import fcntl
+import ast
+import resource
+import math
+import shutil
+import socket
+import urllib.request
+from collections import deque
+import heapq
 try:
     from graphviz import Digraph
     havegraphviz=True
@@ -20,13 +35,58 @@ except ImportError:
 
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
 
-sys.setrecursionlimit(100000)
+# Handler writing messages (dicts) as newline delimited json, each with a 'time' field
+# (unix time). Lines are buffered and written in one go when the buffer holds
+# `capacity` lines or `interval` seconds passed since the last write (and at exit).
+class MetricFileHandler(logging.Handler):
+    def __init__(self, log_file, capacity=1000, interval=10.):
+        logging.Handler.__init__(self)
+        self.log_file = log_file
+        self.capacity = capacity
+        self.interval = interval
+        self.buffer = []
+        self.fp = None # file only created on first write
+        self.lastwrite = time.time()
+
+    def emit(self, record):
+        message = record.msg if isinstance(record.msg, dict) else { 'message':record.getMessage() }
+        entry = { 'time':round(record.created, 3) }
+        entry.update(message)
+        self.buffer.append(json.dumps(entry, default=str))
+        if len(self.buffer) >= self.capacity or record.created - self.lastwrite >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if len(self.buffer) > 0:
+                if self.fp == None:
+                    self.fp = open(self.log_file, 'w')
+                self.fp.write('\n'.join(self.buffer) + '\n')
+                self.fp.flush()
+                self.buffer = []
+            self.lastwrite = time.time()
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush()
+        if self.fp != None:
+            self.fp.close()
+            self.fp = None
+        logging.Handler.close(self)
+
+def make_handler(log_file, structured=False):
+    if structured:
+        return MetricFileHandler(log_file)
+    handler = logging.FileHandler(log_file, mode='w', delay=True) # file only created on first message
+    handler.setFormatter(formatter)
+    return handler
 
-def setup_logger(name, log_file, level=logging.INFO):
+def setup_logger(name, log_file, level=logging.INFO, structured=False):
     """To setup as many loggers as you want"""
 
-    handler = logging.FileHandler(log_file, mode='w')        
-    handler.setFormatter(formatter)
+    handler = make_handler(log_file, structured)
 
     logger = logging.getLogger(name)
     logger.setLevel(level)
@@ -34,18 +94,91 @@ def setup_logger(name, log_file, level=logging.INFO):
 
     return logger
 
+# redirects a logger (set up with setup_logger) to another file
+def set_log_file(logger, log_file):
+    for h in list(logger.handlers):
+        logger.removeHandler(h)
+        h.close()
+        logger.addHandler(make_handler(log_file, isinstance(h, MetricFileHandler)))
+
 # first file logger
 actionlogger = setup_logger('pipeline_action_logger', 'pipeline_action.log', level=logging.DEBUG)
 
-# second file logger
-metriclogger = setup_logger('pipeline_metric_logger', 'pipeline_metric.log')
+# second file logger; structured (json lines, see o2_dpg_workflow_metrics.py for analysis)
+metriclogger = setup_logger('pipeline_metric_logger', 'pipeline_metric.log', structured=True)
 
 # for debugging without terminal access
 # TODO: integrate into standard logger
-def send_webhook(hook, t):
-    if hook!=None:
-      command="curl -X POST -H 'Content-type: application/json' --data '{\"text\":\" " + str(t) + "\"}' " + str(hook) + " &> /dev/null"
-      os.system(command)
+# Sends status messages to a webhook (e.g. Mattermost) from a background thread, so that
+# reporting never blocks scheduling. Messages given with a key are coalesced (only the latest
+# one per key is sent), the rest is queued (bounded). At most one batch of messages is sent
+# per `mininterval` seconds. Targets: http(s)://... (json {"text":...} POST),
+# file:/path (appends lines) or unix:/path (writes lines to a stream socket); the latter
+# two are meant for tests and local consumers.
+class Notifier:
+    def __init__(self, target, mininterval=2., maxqueue=1000):
+        self.target = target
+        self.mininterval = mininterval
+        self.queue = deque(maxlen=maxqueue)
+        self.latest = {} # key -> latest message
+        self.dropped = 0
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name='notifier', daemon=True)
+        self.thread.start()
+
+    def notify(self, message, key=None):
+        with self.condition:
+            if key != None:
+                self.latest[key] = message
+            else:
+                if len(self.queue) == self.queue.maxlen:
+                    self.dropped += 1
+                self.queue.append(message)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.queue) == 0 and len(self.latest) == 0 and not self.stopping:
+                    self.condition.wait()
+                if self.stopping and len(self.queue) == 0 and len(self.latest) == 0:
+                    return
+                messages = list(self.queue) + list(self.latest.values())
+                if self.dropped > 0:
+                    messages.append('(' + str(self.dropped) + ' messages dropped)')
+                self.queue.clear()
+                self.latest = {}
+                self.dropped = 0
+            try:
+                self.send('\n'.join(str(m) for m in messages))
+            except Exception as e:
+                actionlogger.info('Notification to ' + self.target + ' failed: ' + str(e))
+            # rate limit; new messages accumulate meanwhile (cut short when stopping)
+            deadline = time.time() + self.mininterval
+            with self.condition:
+                while not self.stopping and time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+
+    def send(self, text):
+        if self.target.startswith('file:'):
+            with open(self.target[len('file:'):], 'a') as fp:
+                fp.write(text + '\n')
+        elif self.target.startswith('unix:'):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(5)
+                sock.connect(self.target[len('unix:'):])
+                sock.sendall((text + '\n').encode())
+        else:
+            request = urllib.request.Request(self.target, data=json.dumps({'text':text}).encode(), headers={'Content-type':'application/json'})
+            urllib.request.urlopen(request, timeout=10).close()
+
+    # sends what is pending and stops the thread (waiting at most timeout seconds)
+    def close(self, timeout=5.):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join(timeout)
 
 # A fallback solution to getting all child procs
 # in case psutil has problems (PermissionError).
@@ -80,131 +213,220 @@ def getChildProcs(basepid):
          
      plist.append(proc)
   return plist
-  
+
+# Event based notification about finished child processes.
+# A (no-op) SIGCHLD handler together with signal.set_wakeup_fd
+# makes the Python signal machinery write into a self-pipe whenever
+# one of our children exits. The scheduler can then block on this pipe
+# (with a timeout) instead of polling in fixed intervals.
+class ChildEventWaiter:
+    def __init__(self):
+        self.readfd, self.writefd = os.pipe()
+        os.set_blocking(self.readfd, False)
+        os.set_blocking(self.writefd, False)
+        signal.set_wakeup_fd(self.writefd, warn_on_full_buffer=False)
+        signal.signal(signal.SIGCHLD, self.SIGCHLDHandler)
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def SIGCHLDHandler(self, signum, frame):
+        # nothing to do; the wakeup fd already got a byte written
+        pass
+
+    # wakes up a waiting scheduler from python code (e.g. other threads)
+    def notify(self):
+        try:
+            os.write(self.writefd, b'\0')
+        except BlockingIOError:
+            pass # pipe full means a wakeup is pending anyway
+
+    # blocks until some child event arrived or the timeout (in seconds) expired;
+    # returns True if woken up by an event
+    def wait(self, timeout=None):
+        if timeout != None and timeout < 0:
+            timeout = 0
+        ready, _, _ = select.select([self.readfd], [], [], timeout)
+        if len(ready) == 0:
+            return False
+        # drain all pending wakeups; we poll all processes anyway
+        try:
+            while len(os.read(self.readfd, 4096)) > 0:
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
 #
-# Code section to find all topological orderings
-# of a DAG. This is used to know when we can schedule
-# things in parallel.
-# Taken from https://www.geeksforgeeks.org/all-topological-sorts-of-a-directed-acyclic-graph/
+# Code section with graph algorithms on the workflow DAG.
+# Nodes are task ids 0..N-1; an edge (src, dest) means that dest needs src.
+# All algorithms are iterative and linear in the number of nodes and edges.
+
+# raised when the workflow "needs" relations do not form a DAG
+class CyclicGraphError(Exception):
+    def __init__(self, nodes):
+        super().__init__('cycle among nodes ' + str(nodes))
+        self.nodes = nodes
 
 # class to represent a graph object
 class Graph:
- 
+
     # Constructor
     def __init__(self, edges, N):
- 
-        # A List of Lists to represent an adjacency list
-        self.adjList = [[] for _ in range(N)]
- 
-        # stores in-degree of a vertex
-        # initialize in-degree of each vertex by 0
-        self.indegree = [0] * N
- 
-        # add edges to the undirected graph
+        self.N = N
+        # adjacency lists in both directions
+        self.successors = [[] for _ in range(N)]
+        self.predecessors = [[] for _ in range(N)]
         for (src, dest) in edges:
- 
-            # add an edge from source to destination
-            self.adjList[src].append(dest)
- 
-            # increment in-degree of destination vertex by 1
-            self.indegree[dest] = self.indegree[dest] + 1
- 
- 
-# Recursive function to find all topological orderings of a given DAG
-def findAllTopologicalOrders(graph, path, discovered, N, allpaths, maxnumber=1):
-    if len(allpaths) >= maxnumber:
-        return
-    
-    # do for every vertex
-    for v in range(N):
- 
-        # proceed only if in-degree of current node is 0 and
-        # current node is not processed yet
-        if graph.indegree[v] == 0 and not discovered[v]:
- 
-            # for every adjacent vertex u of v, reduce in-degree of u by 1
-            for u in graph.adjList[v]:
-                graph.indegree[u] = graph.indegree[u] - 1
- 
-            # include current node in the path and mark it as discovered
-            path.append(v)
-            discovered[v] = True
- 
-            # recur
-            findAllTopologicalOrders(graph, path, discovered, N, allpaths)
- 
-            # backtrack: reset in-degree information for the current node
-            for u in graph.adjList[v]:
-                graph.indegree[u] = graph.indegree[u] + 1
- 
-            # backtrack: remove current node from the path and
-            # mark it as undiscovered
-            path.pop()
-            discovered[v] = False
- 
-    # record valid ordering
-    if len(path) == N:
-        allpaths.append(path.copy())
- 
- 
-# get all topological orderings of a given DAG as a list
-def printAllTopologicalOrders(graph, maxnumber=1):
-    # get number of nodes in the graph
-    N = len(graph.adjList)
- 
-    # create an auxiliary space to keep track of whether vertex is discovered
-    discovered = [False] * N
- 
-    # list to store the topological order
-    path = []
-    allpaths = []
-    # find all topological ordering and print them
-    findAllTopologicalOrders(graph, path, discovered, N, allpaths, maxnumber=maxnumber)
-    return allpaths
-
-# <--- end code section for topological sorts
-
-# find all tasks that depend on a given task (id); when a cache
-# dict is given we can fill for the whole graph in one pass...
-def find_all_dependent_tasks(possiblenexttask, tid, cache={}):
-    c=cache.get(tid)
-    if c!=None:
-        return c
-    
-    daughterlist=[tid]
-    # possibly recurse
-    for n in possiblenexttask[tid]:
-        c = cache.get(n)
-        if c == None:
-            c = find_all_dependent_tasks(possiblenexttask, n, cache)
-        daughterlist = daughterlist + c
-        cache[n]=c
-
-    cache[tid]=daughterlist
-    return list(set(daughterlist))
+            self.successors[src].append(dest)
+            self.predecessors[dest].append(src)
+
+    # nodes which do not need anything
+    def startnodes(self):
+        return [ n for n in range(self.N) if len(self.predecessors[n]) == 0 ]
+
+    # a topological ordering using Kahn's algorithm;
+    # raises CyclicGraphError if the graph is not acyclic
+    def topological_order(self):
+        indegree = [ len(p) for p in self.predecessors ]
+        queue = deque(self.startnodes())
+        order = []
+        while len(queue) > 0:
+            v = queue.popleft()
+            order.append(v)
+            for u in self.successors[v]:
+                indegree[u] -= 1
+                if indegree[u] == 0:
+                    queue.append(u)
+
+        if len(order) != self.N:
+            raise CyclicGraphError(self.cyclic_nodes(indegree))
+        return order
+
+    # Every node on (or behind) a cycle keeps a non-zero in-degree after Kahn.
+    # Peeling off nodes without remaining successors leaves the ones on cycles.
+    def cyclic_nodes(self, indegree):
+        remaining = set(n for n in range(self.N) if indegree[n] > 0)
+        outdegree = { n:sum(1 for u in self.successors[n] if u in remaining) for n in remaining }
+        queue = deque(n for n in remaining if outdegree[n] == 0)
+        while len(queue) > 0:
+            v = queue.popleft()
+            remaining.discard(v)
+            for u in self.predecessors[v]:
+                if u in remaining:
+                    outdegree[u] -= 1
+                    if outdegree[u] == 0:
+                        queue.append(u)
+        return sorted(remaining)
+
+    # all nodes reachable from the given start nodes (including these) following the
+    # successors, or the predecessors when reverse=True; iterative, O(V+E) at most
+    def reachable(self, startnodes, reverse=False):
+        adjacency = self.predecessors if reverse else self.successors
+        seen = set(startnodes)
+        stack = list(seen)
+        while len(stack) > 0:
+            v = stack.pop()
+            for u in adjacency[v]:
+                if u not in seen:
+                    seen.add(u)
+                    stack.append(u)
+        return seen
+
+
+# <--- end code section for graph algorithms
+
+# Length of the most expensive chain of tasks starting at each task
+# (including the task itself) given a cost per task. Computed in one
+# pass over the reversed topological order.
+def critical_path_lengths(graph, order, cost):
+    cpl = [ 0. for _ in range(graph.N) ]
+    for v in reversed(order):
+        longest = 0.
+        for d in graph.successors[v]:
+            longest = max(longest, cpl[d])
+        cpl[v] = cost[v] + longest
+    return cpl
+
+# Keeps track of which tasks are ready to run. Each task holds a counter
+# of direct requirements that did not finish yet; when it drops to zero the
+# task enters a ready queue (a heap ordered by task weight).
+# Releasing the dependents of a finished task costs O(out-degree).
+class ReadinessTracker:
+    def __init__(self, graph, weights):
+        self.successors = graph.successors
+        self.weights = weights
+        self.remaining = [ len(p) for p in graph.predecessors ]
+        self.finished = [ False for _ in range(graph.N) ]
+        self.readyqueue = []
+        for tid in graph.startnodes():
+            self.push(tid)
+
+    def __len__(self):
+        return len(self.readyqueue)
+
+    # (re)inserts a ready task into the queue
+    def push(self, tid):
+        heapq.heappush(self.readyqueue, (self.weights[tid], tid))
+
+    # removes and returns the ready task with the best (smallest) weight
+    def pop(self):
+        return heapq.heappop(self.readyqueue)[1]
+
+    # ready tasks in priority order (for logging)
+    def candidates(self):
+        return [ tid for _, tid in sorted(self.readyqueue) ]
+
+    # marks many tasks as finished at once (e.g. done in a previous run)
+    # and rebuilds the ready queue; O(V+E)
+    def bulk_finished(self, tids):
+        for tid in tids:
+            self.finished[tid] = True
+            for d in self.successors[tid]:
+                self.remaining[d] -= 1
+        self.readyqueue = [ (self.weights[t], t) for t in range(len(self.remaining)) if self.remaining[t] == 0 and not self.finished[t] ]
+        heapq.heapify(self.readyqueue)
+
+    # marks a task as finished; dependents with all requirements
+    # fulfilled are moved to the ready queue and returned
+    def task_finished(self, tid):
+        if self.finished[tid]:
+            return []
+        self.finished[tid] = True
+        released = []
+        for d in self.successors[tid]:
+            self.remaining[d] -= 1
+            if self.remaining[d] == 0:
+                self.push(d)
+                released.append(d)
+        return released
+
+# find all tasks that depend (directly or indirectly) on a given task (id),
+# including the task itself; iterative and linear in the size of the result
+def find_all_dependent_tasks(possiblenexttask, tid):
+    dependents = set([tid])
+    stack = [tid]
+    while len(stack) > 0:
+        for n in possiblenexttask[stack.pop()]:
+            if n not in dependents:
+                dependents.add(n)
+                stack.append(n)
+    return list(dependents)
 
 
 # wrapper taking some edges, constructing the graph,
-# obtain all topological orderings and some other helper data structures
+# obtain a topological ordering and some other helper data structures
 def analyseGraph(edges, nodes):
     # Number of nodes in the graph
     N = len(nodes)
-
-    # candidate list trivial
-    nextjobtrivial = { n:[] for n in nodes }
-    # startnodes
-    nextjobtrivial[-1] = nodes
-    for e in edges:
-        nextjobtrivial[e[0]].append(e[1])
-        if nextjobtrivial[-1].count(e[1]):
-            nextjobtrivial[-1].remove(e[1])
-    
-    # find topological orderings of the graph
-    # create a graph from edges
     graph = Graph(edges, N)
-    orderings = printAllTopologicalOrders(graph)
-            
-    return (orderings, nextjobtrivial)
+
+    # candidate list trivial; -1 holds the start nodes
+    nextjobtrivial = { n:graph.successors[n] for n in nodes }
+    nextjobtrivial[-1] = graph.startnodes()
+
+    # find a topological ordering of the graph
+    orderings = [ graph.topological_order() ]
+
+    return (orderings, nextjobtrivial, graph)
 
 
 def draw_workflow(workflowspec):
@@ -282,72 +504,966 @@ def filter_workflow(workflowspec, targets=[], targetlabels=[]):
                 return True
         return False
     
-    # The following sequence of operations works and is somewhat structured.
-    # However, it builds lookups used elsewhere as well, so some CPU might be saved by reusing
-    # some structures across functions or by doing less passes on the data.
-
     # helper lookup
     tasknametoid = { t['name']:i for i, t in enumerate(workflowspec['stages'],0) }
 
     # build full target list
-    full_target_list = [ t for t in workflowspec['stages'] if task_matches(t['name']) and task_matches_labels(t) ]
-    full_target_name_list = [ t['name'] for t in full_target_list ]
-
-    # build full dependency list for a task t
-    def getallrequirements(t):
-        _l=[]
-        for r in t['needs']:
-            fulltask = workflowspec['stages'][tasknametoid[r]]
-            _l.append(fulltask)
-            _l=_l+getallrequirements(fulltask)
-        return _l
-
-    full_requirements_list = [ getallrequirements(t) for t in full_target_list ]
-
-    # make flat and fetch names only
-    full_requirements_name_list = list(set([ item['name'] for sublist in full_requirements_list for item in sublist ]))
-
-    # inner "lambda" helper answering if a task "name" is needed by given targets
-    def needed_by_targets(name):
-        if full_target_name_list.count(name)!=0:
-            return True
-        if full_requirements_name_list.count(name)!=0:
-            return True
-        return False
+    full_target_list = [ i for i, t in enumerate(workflowspec['stages'],0) if task_matches(t['name']) and task_matches_labels(t) ]
+
+    # everything the targets need, directly or indirectly, in one linear traversal
+    edges = [ (tasknametoid[r], i) for i, t in enumerate(workflowspec['stages'],0) for r in t['needs'] ]
+    graph = Graph(edges, len(workflowspec['stages']))
+    needed = graph.reachable(full_target_list, reverse=True)
 
     # we finaly copy everything matching the targets as well
     # as all their requirements
-    transformedworkflowspec['stages']=[ l for l in workflowspec['stages'] if needed_by_targets(l['name']) ]
+    transformedworkflowspec['stages']=[ l for i, l in enumerate(workflowspec['stages'],0) if i in needed ]
     return transformedworkflowspec
 
 
+# keeps the share of timeframes of one shard (every nshards-th timeframe, starting with
+# the shard-th one) together with everything these timeframes need and all global
+# (timeframe=-1) tasks which need no timeframe task at all. All shards have the latter in
+# common; one of them executes each (see WorkflowExecutor.own_shared_task).
+def shard_workflow(workflowspec, shard, nshards):
+    stages = workflowspec['stages']
+    timeframes = sorted(set(s['timeframe'] for s in stages if s['timeframe'] != -1))
+    mytimeframes = set(timeframes[shard::nshards])
+
+    tasknametoid = { t['name']:i for i, t in enumerate(stages,0) }
+    edges = [ (tasknametoid[r], i) for i, t in enumerate(stages,0) for r in t['needs'] ]
+    graph = Graph(edges, len(stages))
+    needed = graph.reachable([ i for i, s in enumerate(stages,0) if s['timeframe'] in mytimeframes ], reverse=True)
+    # everything depending (transitively) on some timeframe task
+    timeframedependent = graph.reachable([ i for i, s in enumerate(stages,0) if s['timeframe'] != -1 ])
+    keep = needed | set(i for i in range(len(stages)) if not i in timeframedependent)
+
+    # global tasks needing timeframes of several shards cannot be run by a single shard
+    dropped = [ s['name'] for i, s in enumerate(stages,0) if s['timeframe'] == -1 and not i in keep ]
+    if len(dropped) > 0:
+        message = 'Tasks not run by any shard since they need timeframes of other shards (run them without --shard afterwards): ' + str(dropped)
+        print (message)
+        actionlogger.info(message)
+
+    workflowspec['stages'] = [ s for i, s in enumerate(stages,0) if i in keep ]
+    return workflowspec
+
+
 # builds topological orderings (for each timeframe)    
 def build_dag_properties(workflowspec):
     globaltaskuniverse = [ (l, i) for i, l in enumerate(workflowspec['stages'], 1) ]
-    timeframeset = set( l['timeframe'] for l in workflowspec['stages'] )
 
     edges, nodes = build_graph(globaltaskuniverse, workflowspec)
-    tup = analyseGraph(edges, nodes.copy())
+    try:
+        tup = analyseGraph(edges, nodes)
+    except CyclicGraphError as e:
+        print ('Workflow is not a DAG; cyclic dependencies involving tasks ' + str([ globaltaskuniverse[n][0]['name'] for n in e.nodes ]))
+        exit (1)
     # 
     global_next_tasks = tup[1]
 
-    
-    # a simple score for importance of nodes
-    # for each task find number of nodes that depend on a task -> might be weighted with CPU and MEM needs
-    importance_score = [ 0 for n in nodes ]
-    dependency_cache = {}
-    for n in nodes:
-        importance_score[n] = len(find_all_dependent_tasks(global_next_tasks, n, dependency_cache))
-        actionlogger.info("Score for " + str(globaltaskuniverse[n][0]['name']) + " is " + str(importance_score[n]))
-
-    # weight influences scheduling order can be anything user defined ... for the moment we just prefer to stay within a timeframe
-    def getweight(tid):
-        return globaltaskuniverse[tid][0]['timeframe']
-    
-    task_weights = [ getweight(tid) for tid in range(len(globaltaskuniverse)) ]
-        
-    # print (global_next_tasks)
-    return { 'nexttasks' : global_next_tasks, 'weights' : task_weights, 'topological_ordering' : tup[0] }
+    # (task priorities are computed by WorkflowExecutor.compute_task_weights)
+    return { 'nexttasks' : global_next_tasks, 'topological_ordering' : tup[0], 'graph' : tup[2] }
+
+
+#
+# A cache of the filtered workflow together with its analysed DAG (edges and topological
+# order), stored next to the workflow file. It is keyed by the content hash of the workflow
+# file and the filter arguments, so repeated invocations skip json parsing, filtering and
+# graph analysis. The cache is read via mmap and unpickled in one go.
+DAG_CACHE_VERSION = 2
+
+def dag_cache_key(content, targets, targetlabels, shard=None):
+    h = hashlib.sha1(content)
+    h.update(json.dumps([DAG_CACHE_VERSION, targets, targetlabels, shard]).encode())
+    return h.hexdigest()
+
+def read_dag_cache(cachefile, key):
+    try:
+        with open(cachefile, 'rb') as fp:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                cached = pickle.loads(mm)
+    except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+        return None
+    if not isinstance(cached, dict) or cached.get('key') != key:
+        return None
+    return cached
+
+def write_dag_cache(cachefile, cached):
+    # write atomically; a concurrent reader sees either the old or the new cache
+    tmpfile = cachefile + '.' + str(os.getpid())
+    try:
+        with open(tmpfile, 'wb') as fp:
+            pickle.dump(cached, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfile, cachefile)
+    except OSError as e:
+        actionlogger.info('Could not write workflow cache ' + cachefile + ': ' + str(e))
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+# loads, filters and analyses a workflow -- or takes all of it from the cache;
+# returns the workflowspec and the dag properties (None for an empty workflow).
+# The time spent in each phase is recorded in timings (if given).
+def load_compiled_workflow(workflowfile, targets, targetlabels, usecache=True, shard=None, timings=None):
+    if timings == None:
+        timings = {}
+    t0 = time.perf_counter()
+    with open(workflowfile, 'rb') as fp:
+        content = fp.read()
+    cachefile = workflowfile + '.dagcache'
+    if shard != None:
+        cachefile = cachefile + '_shard' + str(shard[0])
+    key = dag_cache_key(content, targets, targetlabels, shard)
+    cached = read_dag_cache(cachefile, key) if usecache else None
+    timings['read'] = time.perf_counter() - t0
+    if cached != None:
+        actionlogger.info('Using compiled workflow from ' + cachefile)
+        workflowspec = cached['workflowspec']
+        graph = Graph(cached['edges'], len(workflowspec['stages']))
+        nexttasks = { n:graph.successors[n] for n in range(graph.N) }
+        nexttasks[-1] = graph.startnodes()
+        return workflowspec, { 'nexttasks' : nexttasks, 'topological_ordering' : [ cached['order'] ], 'graph' : graph }
+
+    t0 = time.perf_counter()
+    workflowspec = filter_workflow(json.loads(content), targets, targetlabels)
+    if shard != None:
+        workflowspec = shard_workflow(workflowspec, shard[0], shard[1])
+    timings['parse_filter'] = time.perf_counter() - t0
+    if len(workflowspec['stages']) == 0:
+        return workflowspec, None
+    t0 = time.perf_counter()
+    workflow = build_dag_properties(workflowspec)
+    timings['analyse'] = time.perf_counter() - t0
+    if usecache:
+        graph = workflow['graph']
+        edges = [ (s, d) for s in range(graph.N) for d in graph.successors[s] ]
+        write_dag_cache(cachefile, { 'key' : key, 'workflowspec' : workflowspec, 'edges' : edges, 'order' : workflow['topological_ordering'][0] })
+    return workflowspec, workflow
+
+
+#
+# Persistent store of measured task resources from previous runs (a sqlite file).
+# Tasks are identified by their name pattern (the timeframe suffix removed)
+# together with their labels, so that measurements of e.g. tpcdigi_1 and
+# tpcdigi_7 are aggregated into one estimate.
+# The history is optional statistics: database errors (e.g. 'database is locked' on a
+# shared filesystem) are logged and the history is disabled, but never abort the workflow.
+class ResourceHistory:
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS taskresources \
+                           (pattern TEXT, labels TEXT, pss REAL, cpu REAL, duration REAL, time REAL)')
+        self.conn.commit()
+        self.pending = [] # buffered measurements, written in batches
+
+    def disable(self, error):
+        actionlogger.error('Resource history disabled after database error: ' + str(error))
+        self.pending = []
+        try:
+            self.conn.close()
+        except sqlite3.Error:
+            pass
+        self.conn = None
+
+    @staticmethod
+    def task_key(name, labels):
+        return (re.sub(r'_\d+$', '', name), ','.join(sorted(labels)))
+
+    # record one finished task; pss in MB (peak), cpu in cores (mean), duration in seconds
+    def add(self, name, labels, pss, cpu, duration):
+        if self.conn == None:
+            return
+        pattern, labelstring = ResourceHistory.task_key(name, labels)
+        self.pending.append((pattern, labelstring, pss, cpu, duration, time.time()))
+        if len(self.pending) >= 50:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0 or self.conn == None:
+            return
+        try:
+            self.conn.executemany('INSERT INTO taskresources VALUES (?,?,?,?,?,?)', self.pending)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.disable(e)
+        self.pending = []
+
+    # aggregated estimates per task key: peak PSS, mean CPU, mean duration, number of runs
+    def estimates(self):
+        result = {}
+        if self.conn == None:
+            return result
+        try:
+            for row in self.conn.execute('SELECT pattern, labels, MAX(pss), AVG(cpu), AVG(duration), COUNT(*) \
+                                          FROM taskresources GROUP BY pattern, labels'):
+                result[(row[0], row[1])] = { 'pss':row[2], 'cpu':row[3], 'duration':row[4], 'count':row[5] }
+        except sqlite3.Error as e:
+            self.disable(e)
+            return {}
+        return result
+
+
+#
+# A manifest recording for each finished task what it was run with: the command,
+# the task environment and the state (size+mtime or content hash) of its declared
+# input files. It is an append-only file with one json record per line, the last
+# record of a task wins. Comparing with the current state tells which done tasks are stale.
+class TaskManifest:
+    def __init__(self, filename, usechecksums=False):
+        self.filename = filename
+        self.usechecksums = usechecksums
+        self.records = {}
+        if os.path.exists(filename):
+            with open(filename) as fp:
+                for line in fp:
+                    try:
+                        r = json.loads(line)
+                    except ValueError:
+                        continue # a truncated last line of an interrupted run
+                    self.records[(r['cwd'], r['name'])] = r
+
+    def file_state(self, path):
+        if not os.path.isfile(path):
+            return None
+        if self.usechecksums:
+            h = hashlib.sha1()
+            with open(path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(1 << 20), b''):
+                    h.update(chunk)
+            return h.hexdigest()
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+
+    # the current fingerprint of a stage; input paths are relative to the stage cwd
+    def fingerprint(self, stage):
+        inputs = {}
+        for i in stage.get('inputs', []):
+            inputs[i] = self.file_state(os.path.join(stage['cwd'], os.path.expandvars(i)))
+        return {'cmd':hashlib.sha1(stage['cmd'].encode()).hexdigest(), 'env':stage.get('env', {}), 'inputs':inputs}
+
+    # returns None if the stage is up-to-date, otherwise the reason why it is stale
+    def stale_reason(self, stage):
+        r = self.records.get((stage['cwd'], stage['name']))
+        if r == None:
+            return None # unknown: done before the manifest was used
+        for o in stage.get('outputs', []):
+            if not os.path.exists(os.path.join(stage['cwd'], os.path.expandvars(o))):
+                return 'output ' + o + ' missing'
+        current = self.fingerprint(stage)
+        if current['cmd'] != r['cmd']:
+            return 'command changed'
+        if json.dumps(current['env'], sort_keys=True) != json.dumps(r['env'], sort_keys=True):
+            return 'environment changed'
+        for i, state in current['inputs'].items():
+            if r['inputs'].get(i, state) != state:
+                return 'input ' + i + ' changed'
+        if set(current['inputs'].keys()) != set(r['inputs'].keys()):
+            return 'declared inputs changed'
+        return None
+
+    # appends the record for a successfully finished stage (with the fingerprint taken at submit time)
+    def record(self, stage, fingerprint):
+        r = dict(fingerprint)
+        r['name'] = stage['name']
+        r['cwd'] = stage['cwd']
+        r['time'] = time.time()
+        self.records[(r['cwd'], r['name'])] = r
+        with open(self.filename, 'a') as fp:
+            fp.write(json.dumps(r) + '\n')
+
+
+#
+# Writes a trace of the execution in the Chrome Trace Event format (viewable in
+# Perfetto or chrome://tracing). Every task is a slice on the track of the slot it
+# occupied; submissions, skips and failures are instant events and resources are
+# counter tracks. Events are streamed to the file as they happen.
+class TraceWriter:
+    def __init__(self, filename, clock=time.time):
+        self.fp = open(filename, 'w')
+        self.fp.write('[\n')
+        self.lock = threading.Lock() # the monitor thread writes counters concurrently
+        self.clock = clock
+        self.starttime = clock()
+        self.freeslots = [] # heap of released slot numbers
+        self.nslots = 0
+        self.taskslot = {} # task id -> (slot, start timestamp)
+        self.event({'ph':'M', 'name':'process_name', 'pid':1, 'args':{'name':'o2_dpg_workflow_runner'}})
+
+    def timestamp(self):
+        return int((self.clock() - self.starttime)*1e6)
+
+    def event(self, e):
+        e.setdefault('pid', 1)
+        with self.lock:
+            if self.fp != None:
+                self.fp.write(json.dumps(e) + ',\n')
+
+    def task_started(self, tid, name, backfill=False):
+        if len(self.freeslots) > 0:
+            slot = heapq.heappop(self.freeslots)
+        else:
+            slot = self.nslots
+            self.nslots += 1
+            self.event({'ph':'M', 'name':'thread_name', 'tid':slot, 'args':{'name':'slot ' + str(slot)}})
+        ts = self.timestamp()
+        self.taskslot[tid] = (slot, ts)
+        self.event({'ph':'i', 's':'t', 'name':('backfill ' if backfill else 'submit ') + name, 'cat':'backfill' if backfill else 'submit', 'ts':ts, 'tid':slot})
+
+    def task_finished(self, tid, name, returncode, args={}):
+        slot, start = self.taskslot.pop(tid, (None, None))
+        if slot == None:
+            return
+        ts = self.timestamp()
+        self.event({'ph':'X', 'name':name, 'cat':'task', 'ts':start, 'dur':ts - start, 'tid':slot, 'args':dict(args, returncode=returncode)})
+        if returncode != 0:
+            self.event({'ph':'i', 's':'g', 'name':'failure ' + name, 'cat':'failure', 'ts':ts})
+        heapq.heappush(self.freeslots, slot)
+
+    def task_skipped(self, name):
+        self.event({'ph':'i', 's':'g', 'name':'skip ' + name, 'cat':'skip', 'ts':self.timestamp()})
+
+    def counter(self, name, values):
+        self.event({'ph':'C', 'name':name, 'ts':self.timestamp(), 'args':values})
+
+    def close(self):
+        with self.lock:
+            if self.fp == None:
+                return
+            # closes the array with a last (harmless) metadata event
+            self.fp.write(json.dumps({'ph':'M', 'pid':1, 'name':'process_labels', 'args':{'labels':'finished'}}) + '\n]\n')
+            self.fp.close()
+            self.fp = None
+
+
+#
+# Code section for distributed execution: the runner acts as coordinator and places
+# tasks on worker agents (o2_dpg_workflow_worker.py) which advertise their resources.
+# Working directories are expected to be on a filesystem shared by all workers.
+
+# A task executed by a worker agent. Mimics the parts of the Popen interface
+# used by the executor (pid, poll, kill, terminate).
+class RemoteTask:
+    def __init__(self, worker, tid):
+        self.worker = worker
+        self.tid = tid
+        self.pid = None # pid on the worker host; known once started
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self):
+        self.worker.kill(self.tid)
+
+    def terminate(self):
+        self.worker.kill(self.tid)
+
+    def __str__(self):
+        return 'RemoteTask(' + str(self.tid) + '@' + self.worker.host + ':' + str(self.pid) + ')'
+
+# The coordinator side of the connection to one worker agent. A reader thread
+# collects task completions and wakes up the scheduler.
+class RemoteWorker:
+    def __init__(self, address, childevents, token):
+        from o2_dpg_workflow_worker import connect, read_messages, send_message, auth_digest
+        self.send_message = send_message
+        self.address = address
+        self.lock = threading.Lock()
+        self.sock = connect(address)
+        self.messages = read_messages(self.sock)
+        challenge = next(self.messages)
+        self.send_message(self.sock, self.lock, {'type':'auth', 'digest':auth_digest(token, challenge['nonce'])})
+        hello = next(self.messages) # the worker closes the connection if authentication failed
+        self.host = hello['host']
+        self.cpu = float(hello['cpu'])
+        self.mem = float(hello['mem'])
+        self.cpubooked = 0.
+        self.membooked = 0.
+        self.tasks = {} # task id -> RemoteTask
+        self.childevents = childevents
+        self.alive = True
+        self.readerthread = threading.Thread(target=self.read_loop, name='worker-' + address, daemon=True)
+        self.readerthread.start()
+
+    def read_loop(self):
+        try:
+            for message in self.messages:
+                task = self.tasks.get(message['id'])
+                if task == None:
+                    continue
+                if message['type'] == 'started':
+                    task.pid = message['pid']
+                elif message['type'] == 'finished':
+                    task.returncode = message['returncode']
+                    self.childevents.notify()
+        except (OSError, ValueError) as e:
+            actionlogger.error('Connection to worker ' + self.address + ' failed: ' + str(e))
+        # connection lost; everything still running there counts as failed
+        self.alive = False
+        for task in list(self.tasks.values()):
+            if task.returncode == None:
+                task.returncode = -1
+        self.childevents.notify()
+
+    def fits(self, cpu, mem, softcpufactor=1.):
+        return self.alive and self.cpubooked + cpu <= softcpufactor*self.cpu and self.membooked + mem <= self.mem
+
+    def run(self, tid, cmd, workdir, env, nice, cpu, mem):
+        task = RemoteTask(self, tid)
+        self.tasks[tid] = task
+        self.cpubooked += cpu
+        self.membooked += mem
+        self.send_message(self.sock, self.lock, {'type':'run', 'id':tid, 'cmd':cmd, 'cwd':workdir, 'env':env, 'nice':nice})
+        return task
+
+    def release(self, tid, cpu, mem):
+        if self.tasks.pop(tid, None) != None:
+            self.cpubooked -= cpu
+            self.membooked -= mem
+
+    def kill(self, tid):
+        try:
+            self.send_message(self.sock, self.lock, {'type':'kill', 'id':tid})
+        except OSError:
+            pass
+
+# <--- end code section for distributed execution
+
+
+#
+# Code section for per-task cgroup (v2) confinement. Every task gets its own child group
+# below o2dpg_<pid> (created inside the runner's own cgroup) with memory.max and cpu.max
+# set from the declared resources. The kernel then does the accounting of the whole
+# process tree, which we read in O(1) per task, and cgroup.kill tears down leftovers.
+#
+# cgroup v2 only allows enabling controllers for the children of a (non-root) group which
+# holds no processes itself. The runner therefore needs a delegated cgroup of its own
+# (e.g. systemd-run --user --scope -p Delegate=yes ...) and moves itself into the leaf
+# o2dpg_<pid>/runner before enabling the controllers on the now empty parents:
+#   <own cgroup>/o2dpg_<pid>/runner     the runner
+#   <own cgroup>/o2dpg_<pid>/task<id>   one group per task
+class TaskCgroups:
+    CONTROLLERS = ['memory', 'cpu'] # memory is required, the others are used if available
+
+    def __init__(self):
+        base = TaskCgroups.own_cgroup()
+        available = open(base + '/cgroup.controllers').read().split()
+        if not TaskCgroups.CONTROLLERS[0] in available:
+            raise OSError(TaskCgroups.CONTROLLERS[0] + ' controller not available in ' + base)
+        self.controllers = [ c for c in TaskCgroups.CONTROLLERS if c in available ]
+        enable = ' '.join('+' + c for c in self.controllers)
+        self.base = base
+        self.enabledbase = set(self.controllers) - set(open(base + '/cgroup.subtree_control').read().split())
+        # (the root group is exempt from the rule)
+        if len(self.enabledbase) > 0 and os.path.exists(base + '/cgroup.type'):
+            others = [ pid for pid in TaskCgroups.read_procs(base) if pid != os.getpid() ]
+            if len(others) > 0:
+                raise OSError('cgroup ' + base + ' also contains other processes ' + str(others[:5])
+                              + '; start the runner in a delegated cgroup of its own (e.g. systemd-run --user --scope -p Delegate=yes)')
+        self.parent = base + '/o2dpg_' + str(os.getpid())
+        self.runnergroup = self.parent + '/runner'
+        os.mkdir(self.parent)
+        try:
+            os.mkdir(self.runnergroup)
+            TaskCgroups.write(self.runnergroup + '/cgroup.procs', str(os.getpid()))
+            if len(self.enabledbase) > 0:
+                TaskCgroups.write(base + '/cgroup.subtree_control', ' '.join('+' + c for c in self.enabledbase))
+            TaskCgroups.write(self.parent + '/cgroup.subtree_control', enable)
+        except OSError:
+            self.release()
+            raise
+        self.taskgroups = {} # task id -> cgroup directory
+        self.lastcpu = {} # task id -> (cpu usage in usec, time) of previous sample
+        self.busy = [] # groups of finished tasks which could not be removed yet
+        self.lock = threading.Lock() # busy is swept by the monitor thread
+
+    # the cgroup v2 directory of this process (also in hybrid v1/v2 setups)
+    @staticmethod
+    def own_cgroup():
+        mountpoint = None
+        with open('/proc/self/mounts') as fp:
+            for line in fp:
+                fields = line.split()
+                if fields[2] == 'cgroup2':
+                    mountpoint = fields[1]
+        if mountpoint == None:
+            raise OSError('no cgroup v2 hierarchy mounted')
+        with open('/proc/self/cgroup') as fp:
+            for line in fp:
+                if line.startswith('0::'):
+                    return mountpoint + line[3:].strip().rstrip('/')
+        raise OSError('not part of a cgroup v2 hierarchy')
+
+    @staticmethod
+    def write(filename, value):
+        with open(filename, 'w') as fp:
+            fp.write(value)
+
+    @staticmethod
+    def read_procs(path):
+        with open(path + '/cgroup.procs') as fp:
+            return [ int(pid) for pid in fp.read().split() ]
+
+    @staticmethod
+    def read_keyed(filename):
+        result = {}
+        with open(filename) as fp:
+            for line in fp:
+                key, value = line.split()
+                result[key] = int(value)
+        return result
+
+    # creates the group of a task; cpu in cores, mem in MB (values <= 0 mean unlimited)
+    def create(self, tid, cpu, mem):
+        path = self.parent + '/task' + str(tid)
+        try:
+            os.mkdir(path)
+            if mem > 0:
+                TaskCgroups.write(path + '/memory.max', str(int(mem*1024*1024)))
+            if cpu > 0 and 'cpu' in self.controllers:
+                TaskCgroups.write(path + '/cpu.max', str(int(cpu*100000)) + ' 100000')
+        except OSError as e:
+            actionlogger.info('Could not create cgroup for task ' + str(tid) + ': ' + str(e))
+            return None
+        self.taskgroups[tid] = path
+        return path
+
+    # function to be run in the child (before exec) to move it into the group
+    @staticmethod
+    def joiner(path):
+        def join():
+            TaskCgroups.write(path + '/cgroup.procs', '0')
+        return join
+
+    # current usage of a task: memory in MB and CPU load (in percent as psutil) since the previous call
+    def usage(self, tid):
+        path = self.taskgroups.get(tid)
+        if path == None:
+            return None
+        try:
+            current = int(open(path + '/memory.current').read())
+            memstat = TaskCgroups.read_keyed(path + '/memory.stat')
+            cpuusage = TaskCgroups.read_keyed(path + '/cpu.stat')['usage_usec']
+            swap = int(open(path + '/memory.swap.current').read()) if os.path.exists(path + '/memory.swap.current') else 0
+        except (OSError, ValueError, KeyError):
+            return None
+        now = time.time()
+        previous = self.lastcpu.get(tid)
+        self.lastcpu[tid] = (cpuusage, now)
+        cpu = 0.
+        if previous != None and now > previous[1]:
+            cpu = 100.*(cpuusage - previous[0])/1e6/(now - previous[1])
+        # the working set: everything charged except reclaimable inactive page cache
+        workingset = current - memstat.get('inactive_file', 0)
+        return { 'cpu':cpu, 'pss':workingset/1024./1024., 'uss':memstat.get('anon', 0)/1024./1024., 'swap':swap }
+
+    # kills whatever is still alive in the group of a task and removes it
+    def remove(self, tid):
+        path = self.taskgroups.pop(tid, None)
+        self.lastcpu.pop(tid, None)
+        if path == None:
+            return
+        try:
+            TaskCgroups.write(path + '/cgroup.kill', '1')
+        except OSError:
+            pass
+        # killed processes disappear asynchronously; groups still busy are removed later
+        # (by sweep) instead of waiting here on the scheduler thread
+        if not TaskCgroups.try_rmdir(path):
+            with self.lock:
+                self.busy.append(path)
+
+    # True if the group is gone
+    @staticmethod
+    def try_rmdir(path):
+        try:
+            os.rmdir(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return False
+        return True
+
+    # removes groups which were busy before (called with every monitoring sample)
+    def sweep(self):
+        with self.lock:
+            self.busy = [ path for path in self.busy if not TaskCgroups.try_rmdir(path) ]
+
+    def cleanup(self):
+        for tid in list(self.taskgroups.keys()):
+            self.remove(tid)
+        for i in range(50):
+            self.sweep()
+            if len(self.busy) == 0:
+                break
+            time.sleep(0.01)
+        for path in self.busy:
+            actionlogger.info('Could not remove cgroup ' + path)
+        self.release()
+
+    # undoes the setup: controllers are disabled again, so that the runner may return to its original group
+    def release(self):
+        if not os.path.exists(self.parent):
+            return
+        try:
+            if os.path.exists(self.parent + '/cgroup.subtree_control'):
+                TaskCgroups.write(self.parent + '/cgroup.subtree_control', ' '.join('-' + c for c in self.controllers))
+            if len(self.enabledbase) > 0:
+                TaskCgroups.write(self.base + '/cgroup.subtree_control', ' '.join('-' + c for c in self.enabledbase))
+            if os.path.exists(self.runnergroup):
+                TaskCgroups.write(self.base + '/cgroup.procs', str(os.getpid()))
+                os.rmdir(self.runnergroup)
+            os.rmdir(self.parent)
+        except OSError as e:
+            actionlogger.info('Could not remove cgroup ' + self.parent + ': ' + str(e))
+
+# <--- end code section for per-task cgroups
+
+
+#
+# Code section for a low overhead process sampler reading /proc directly.
+# Memory comes from smaps_rollup (one pre-summed record instead of parsing every
+# mapping in smaps), CPU from stat and I/O from io. Process trees are followed via
+# /proc/<pid>/task/<tid>/children. Per-process state is evicted once a pid is gone.
+class ProcSampler:
+    def __init__(self):
+        self.clockticks = float(os.sysconf('SC_CLK_TCK'))
+        self.lastcpu = {} # pid -> (cpu ticks, time) of the previous sample
+        self.seen = set() # pids sampled in the current round
+        self.cpucost = 0. # CPU seconds spent in the last round
+        self.wallcost = 0.
+        self.nprocs = 0
+
+    # whether the kernel offers everything we need
+    @staticmethod
+    def available():
+        pid = os.getpid()
+        return os.path.exists('/proc/self/smaps_rollup') and os.path.exists('/proc/' + str(pid) + '/task/' + str(pid) + '/children')
+
+    # pid and all its descendants
+    def tree(self, pid):
+        result = []
+        todo = [ pid ]
+        while len(todo) > 0:
+            p = todo.pop()
+            result.append(p)
+            try:
+                for t in os.listdir('/proc/' + str(p) + '/task'):
+                    with open('/proc/' + str(p) + '/task/' + t + '/children') as fp:
+                        todo.extend(int(c) for c in fp.read().split())
+            except (FileNotFoundError, ProcessLookupError, PermissionError):
+                pass
+        return result
+
+    def begin(self):
+        self.seen = set()
+        self.nprocs = 0
+        self.starttime = (time.perf_counter(), time.thread_time())
+        with open('/proc/uptime') as fp:
+            self.uptime = float(fp.read().split()[0])
+
+    # finishes a sampling round: forgets processes which are gone and records the own cost
+    def end(self):
+        for pid in list(self.lastcpu.keys()):
+            if not pid in self.seen:
+                del self.lastcpu[pid]
+        self.wallcost = time.perf_counter() - self.starttime[0]
+        self.cpucost = time.thread_time() - self.starttime[1]
+
+    # summed usage of a process tree: cpu in percent (as psutil), memory in MB, io in bytes;
+    # None if the top process is gone
+    def task_usage(self, pid):
+        total = { 'cpu':0., 'pss':0., 'uss':0., 'swap':0., 'read_bytes':0, 'write_bytes':0 }
+        found = False
+        now = time.time()
+        for p in self.tree(pid):
+            procdir = '/proc/' + str(p)
+            try:
+                with open(procdir + '/stat') as fp:
+                    stat = fp.read()
+                with open(procdir + '/smaps_rollup') as fp:
+                    rollup = fp.read()
+            except (FileNotFoundError, ProcessLookupError, PermissionError):
+                continue
+            found = True
+            self.seen.add(p)
+            self.nprocs += 1
+            # fields after the command name (which may contain spaces)
+            fields = stat[stat.rfind(')')+2:].split()
+            cputicks = int(fields[11]) + int(fields[12])
+            previous = self.lastcpu.get(p)
+            if previous != None:
+                if now > previous[1]:
+                    total['cpu'] += 100.*(cputicks - previous[0])/self.clockticks/(now - previous[1])
+            else:
+                # average since process start
+                age = self.uptime - int(fields[19])/self.clockticks
+                if age > 0:
+                    total['cpu'] += 100.*cputicks/self.clockticks/age
+            self.lastcpu[p] = (cputicks, now)
+
+            for line in rollup.splitlines():
+                key, _, value = line.partition(':')
+                if key == 'Pss':
+                    total['pss'] += int(value.split()[0])/1024.
+                elif key == 'Private_Clean' or key == 'Private_Dirty':
+                    total['uss'] += int(value.split()[0])/1024.
+                elif key == 'Swap':
+                    total['swap'] += int(value.split()[0])*1024
+
+            try:
+                with open(procdir + '/io') as fp:
+                    for line in fp:
+                        key, _, value = line.partition(':')
+                        if key == 'read_bytes' or key == 'write_bytes':
+                            total[key] += int(value)
+            except (FileNotFoundError, ProcessLookupError, PermissionError):
+                pass
+        return total if found else None
+
+# <--- end code section for the process sampler
+
+
+#
+# Code section for pinning tasks to cores. The allocator hands out sets of cores
+# (sized by the declared cpu of a task) from the cores available to the runner,
+# preferring contiguous cores within one NUMA node.
+
+# parses a kernel cpu list such as "0-3,8-11"
+def parse_cpulist(cpulist):
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if part == '':
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last if last != '' else first) + 1))
+    return cpus
+
+# formats a list of cpus as kernel cpu list
+def format_cpulist(cpus):
+    ranges = []
+    for c in sorted(cpus):
+        if len(ranges) > 0 and ranges[-1][1] == c - 1:
+            ranges[-1][1] = c
+        else:
+            ranges.append([c, c])
+    return ','.join(str(a) if a == b else str(a) + '-' + str(b) for a, b in ranges)
+
+class CoreAllocator:
+    # nodes: NUMA node -> list of cpus (of those available to us)
+    def __init__(self, nodes):
+        self.nodes = { n : sorted(cpus) for n, cpus in nodes.items() if len(cpus) > 0 }
+        self.ncores = sum(len(cpus) for cpus in self.nodes.values())
+        self.free = set(c for cpus in self.nodes.values() for c in cpus)
+        self.assignment = {} # task id -> (list of cpus, NUMA node or None when spanning nodes)
+
+    # the cpus this process may run on, grouped by NUMA node (from /sys/devices/system)
+    @staticmethod
+    def from_system():
+        available = os.sched_getaffinity(0)
+        nodes = {}
+        nodedir = '/sys/devices/system/node'
+        try:
+            for entry in os.listdir(nodedir):
+                if entry.startswith('node') and entry[4:].isdigit():
+                    with open(nodedir + '/' + entry + '/cpulist') as fp:
+                        nodes[int(entry[4:])] = [ c for c in parse_cpulist(fp.read()) if c in available ]
+        except OSError:
+            nodes = {}
+        if len(nodes) == 0:
+            # no NUMA information; one node with everything we have
+            nodes[0] = sorted(available)
+        return CoreAllocator(nodes)
+
+    # runs of consecutive free cpus (in node order) of one node
+    def free_runs(self, node):
+        runs = []
+        for c in self.nodes[node]:
+            if c in self.free:
+                if len(runs) > 0 and runs[-1][-1] == c - 1:
+                    runs[-1].append(c)
+                else:
+                    runs.append([c])
+        return runs
+
+    # assigns n cores to a task; returns (cpus, node) or None if not enough cores are free
+    def allocate(self, tid, n):
+        n = max(1, min(n, self.ncores))
+        if len(self.free) < n:
+            return None
+        # 1) the smallest contiguous run within one node that fits (best fit against fragmentation)
+        best = None
+        for node in self.nodes:
+            for run in self.free_runs(node):
+                if len(run) >= n and (best == None or len(run) < len(best[0])):
+                    best = (run, node)
+        if best != None:
+            cpus, node = best[0][:n], best[1]
+        else:
+            # 2) any free cores of a single node; 3) spread over the nodes with most free cores
+            fitting = [ node for node in self.nodes if sum(1 for c in self.nodes[node] if c in self.free) >= n ]
+            if len(fitting) > 0:
+                node = fitting[0]
+                cpus = [ c for c in self.nodes[node] if c in self.free ][:n]
+            else:
+                node = None
+                cpus = []
+                for nd in sorted(self.nodes, key=lambda nd : -sum(1 for c in self.nodes[nd] if c in self.free)):
+                    cpus.extend(c for c in self.nodes[nd] if c in self.free)
+                cpus = cpus[:n]
+        self.free.difference_update(cpus)
+        self.assignment[tid] = (cpus, node)
+        return (cpus, node)
+
+    def release(self, tid):
+        a = self.assignment.pop(tid, None)
+        if a != None:
+            self.free.update(a[0])
+
+# <--- end code section for core pinning
+
+
+#
+# Code section for the scheduler simulation (--simulate). Tasks are not executed but
+# replaced by SimulatedProcess objects which finish after their expected duration on
+# a virtual clock; the scheduling logic of the executor runs unchanged on top of it.
+SIMULATION_DEFAULT_DURATION = 60. # seconds assumed for tasks without any timing information
+
+class SimulatedProcess:
+    def __init__(self, simulation, tid, endtime):
+        self.simulation = simulation
+        self.tid = tid
+        self.pid = -1 - tid
+        self.endtime = endtime
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode == None and self.simulation.now >= self.endtime:
+            self.returncode = 0
+        return self.returncode
+
+    def kill(self):
+        self.returncode = -9
+
+    def terminate(self):
+        self.returncode = -15
+
+# reads task durations (and optionally resources) from a profile: either a json file
+# { taskname : seconds } or { taskname : {'duration':seconds, 'cpu':cores, 'mem':MB} },
+# or a pipeline_metric.log of a previous run (durations of finished tasks, otherwise
+# from the first to the last sample; older logs with python dicts are understood as well)
+def load_simulation_profile(filename):
+    if filename.endswith('.json'):
+        with open(filename) as fp:
+            profile = json.load(fp)
+        return { name : (p if isinstance(p, dict) else {'duration':float(p)}) for name, p in profile.items() }
+
+    firstlast = {}
+    durations = {}
+    with open(filename) as fp:
+        for line in fp:
+            if line.startswith('{'):
+                try:
+                    sample = json.loads(line)
+                except ValueError:
+                    continue
+                stamp = sample.get('time')
+            else:
+                # old format: "<date> <time>,<ms> INFO {python dict}"
+                pos = line.find('{')
+                if pos == -1:
+                    continue
+                try:
+                    sample = ast.literal_eval(line[pos:])
+                    stamp = time.mktime(time.strptime(line[:19], '%Y-%m-%d %H:%M:%S')) + float(line[20:23])/1000.
+                except (ValueError, SyntaxError):
+                    continue
+            if not isinstance(sample, dict) or sample.get('name') == None or stamp == None:
+                continue
+            name = sample['name']
+            if sample.get('type') == 'task_end':
+                durations[name] = sample['duration']
+            elif 'pss' in sample:
+                first, last = firstlast.get(name, (stamp, stamp))
+                firstlast[name] = (min(first, stamp), max(last, stamp))
+    for name, (first, last) in firstlast.items():
+        durations.setdefault(name, last - first)
+    return { name : {'duration':d} for name, d in durations.items() }
+
+# the wall time recorded by the taskwrapper in <cwd>/<name>.log_time (second field)
+def read_task_walltime(stage):
+    try:
+        with open(stage['cwd'] + '/' + stage['name'] + '.log_time') as fp:
+            return float(fp.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+class Simulation:
+    # fallbackdurations: durations (seconds) to use before the synthetic default
+    def __init__(self, stages, profilefile, fallbackdurations=None):
+        self.now = 0.
+        profile = load_simulation_profile(profilefile) if profilefile != '' else {}
+        self.durations = []
+        self.resources = [] # (cpu, mem) overrides from the profile
+        nsources = {'profile':0, 'log_time':0, 'history':0, 'default':0}
+        for tid, stage in enumerate(stages):
+            p = profile.get(stage['name'], profile.get(re.sub(r'_\d+$', '', stage['name'])))
+            duration = None
+            if p != None and p.get('duration') != None:
+                duration, source = float(p['duration']), 'profile'
+            if duration == None:
+                duration, source = read_task_walltime(stage), 'log_time'
+            if duration == None and fallbackdurations != None:
+                duration, source = fallbackdurations[tid], 'history'
+            if duration == None:
+                duration, source = SIMULATION_DEFAULT_DURATION, 'default'
+            nsources[source] += 1
+            self.durations.append(duration)
+            self.resources.append((p.get('cpu'), p.get('mem')) if p != None else (None, None))
+        actionlogger.info('Simulated task durations from ' + str(nsources))
+        self.bookedcoreseconds = 0.
+        self.peakmem = 0.
+        self.peakcpu = 0.
+
+    def clock(self):
+        return self.now
+
+    def start(self, tid):
+        return SimulatedProcess(self, tid, self.now + self.durations[tid])
+
+    # jumps to the next moment a running task finishes
+    def advance(self, process_list, bookedcpu):
+        nextend = min(p.endtime for _, p in process_list)
+        self.bookedcoreseconds += bookedcpu * (nextend - self.now)
+        self.now = max(self.now, nextend)
+
+    def record_booking(self, cpu, mem):
+        self.peakcpu = max(self.peakcpu, cpu)
+        self.peakmem = max(self.peakmem, mem)
+
+    def report(self, cpulimit):
+        utilisation = self.bookedcoreseconds / (cpulimit * self.now) if self.now > 0 else 0.
+        lines = [ 'Simulated makespan:     ' + '%.1f' % self.now + ' s',
+                  'Core utilisation:       ' + '%.1f' % (100.*utilisation) + ' % of ' + str(cpulimit) + ' cores (booked, including backfill)',
+                  'Peak booked CPU:        ' + '%.2f' % self.peakcpu + ' cores',
+                  'Peak booked memory:     ' + '%.0f' % self.peakmem + ' MB' ]
+        for l in lines:
+            print (l)
+            actionlogger.info(l)
+
+# <--- end code section for the scheduler simulation
+
+
+# parses the --shard argument "i/N"
+def parse_shard(shardarg):
+    try:
+        shard, nshards = [ int(x) for x in shardarg.split('/') ]
+    except ValueError:
+        shard, nshards = -1, 0
+    if nshards < 1 or shard < 0 or shard >= nshards:
+        print ('Invalid shard ' + shardarg + '; expected i/N with 0 <= i < N')
+        exit (1)
+    return (shard, nshards)
 
 
 #
@@ -358,19 +1474,20 @@ class WorkflowExecutor:
     def __init__(self, workflowfile, args, jmax=100):
       self.args=args
       self.workflowfile = workflowfile
-      self.workflowspec = load_workflow(workflowfile)
-      self.workflowspec = filter_workflow(self.workflowspec, args.target_tasks, args.target_labels)
+      self.shard = parse_shard(args.shard) if args.shard != None else None # (i, N) when running timeframe shard i of N
+      self.starttime = time.time()
+      self.phasetimings = {} # seconds spent in the startup phases
+      self.workflowspec, workflow = load_compiled_workflow(workflowfile, args.target_tasks, args.target_labels, not args.no_dag_cache, self.shard, self.phasetimings)
 
       if len(self.workflowspec['stages']) == 0:
           print ('Workflow is empty. Nothing to do')
           exit (0)
       
-      workflow = build_dag_properties(self.workflowspec)
       if args.visualize_workflow:
           draw_workflow(self.workflowspec)
       self.possiblenexttask = workflow['nexttasks']
-      self.taskweights = workflow['weights']
       self.topological_orderings = workflow['topological_ordering']
+      self.graph = workflow['graph']
       self.taskuniverse = [ l['name'] for l in self.workflowspec['stages'] ]
       self.idtotask = [ 0 for l in self.taskuniverse ]
       self.tasktoid = {}
@@ -384,27 +1501,133 @@ class WorkflowExecutor:
       self.curcpubooked = 0
       self.curmembooked_backfill = 0
       self.curcpubooked_backfill = 0
-      self.memlimit = float(args.mem_limit) # some configurable number
+      self.memlimit = float(args.mem_limit) # in MB like the task resources and the measured PSS
       self.cpulimit = float(args.cpu_limit)
+      self.childevents = ChildEventWaiter() # wakes us up when child processes (or remote tasks) finish
+      self.workers = None # remote worker agents (if running as coordinator)
+      self.taskworker = {} # task id -> worker executing it
+      if args.workers != None:
+          self.connect_workers(args.workers.split(','))
       self.procstatus = { tid:'ToDo' for tid in range(len(self.workflowspec['stages'])) }
-      self.taskneeds= { t:set(self.getallrequirements(t)) for t in self.taskuniverse }
-      self.stoponfailure = True
+      self.taskdurations = [ 1. for tid in range(len(self.taskuniverse)) ] # expected durations (arbitrary units) used for priorities
+      self.resourcehistory = None
+      if args.resource_history != None:
+          try:
+              self.resourcehistory = ResourceHistory(args.resource_history)
+          except sqlite3.Error as e:
+              print ('Cannot open resource history ' + args.resource_history + ' (' + str(e) + '); continuing without')
+              actionlogger.error('Cannot open resource history ' + args.resource_history + ': ' + str(e))
+      if args.use_resource_history:
+          self.apply_resource_history()
+      self.simulation = None
+      if args.simulate != None:
+          self.simulation = Simulation(self.workflowspec['stages'], args.simulate, self.taskdurations if args.use_resource_history else None)
+          self.taskdurations = list(self.simulation.durations)
+          for tid, (cpu, mem) in enumerate(self.simulation.resources):
+              if cpu != None:
+                  self.cpuperid[tid] = cpu
+              if mem != None:
+                  self.maxmemperid[tid] = mem
+          self.doneindex = set() # simulate the complete workflow
+      self.tasksubmittime = {} # wall time when task was submitted
+      self.envcache = {} # task specific environment -> full environment of the task
+      self.workdirs = set() # working directories known to exist
+      self.taskreadytime = {} # wall time when all requirements of a task were fulfilled
+      self.taskdetecttime = {} # wall time when the end of a task was noticed
+      self.taskreturncode = {} # exit code of the last attempt of a task
+      self.manifest = TaskManifest(args.manifest, args.manifest_checksums) if args.manifest != None else None
+      self.taskfingerprints = {} # manifest fingerprints taken at submit time
+      self.taskmeasurements = {} # accumulated monitoring values per task id (filled by monitor thread)
+      self.taskweights = self.compute_task_weights(args.scheduling_policy)
+      self.stoponfailure = not args.keep_going
+      self.poisoned = [] # tasks not executed because something they depend on failed (--keep-going)
+      self.draining = None # deadline (wall time) of the grace period once draining after a failure
+      self.failedtasks = [] # tasks which failed
+      self.attempts = {} # task id -> number of failed attempts which were retried
+      self.retryqueue = [] # heap of (wall time when due, task id) of failed tasks to be retried
+      self.drainfinished = [] # tasks which completed while draining
       self.max_jobs_parallel = int(jmax)
       self.scheduling_iteration = 0
       self.process_list = []  # list of currently scheduled tasks with normal priority
       self.backfill_process_list = [] # list of curently scheduled tasks with low backfill priority (not sure this is needed)
-      self.pid_to_psutilsproc = {}  # cache of putilsproc for resource monitoring
+      self.pid_to_psutilsproc = {}  # cache of putilsproc for resource monitoring (if /proc can't be sampled directly)
+      self.procsampler = ProcSampler() if ProcSampler.available() else None
       self.pid_to_files = {} # we can auto-detect what files are produced by which task (at least to some extent)
       self.pid_to_connections = {} # we can auto-detect what connections are opened by which task (at least to some extent)
       signal.signal(signal.SIGINT, self.SIGHandler)
       signal.siginterrupt(signal.SIGINT, False)
       self.nicevalues = [ os.nice(0) for tid in range(len(self.taskuniverse)) ]
-      self.internalmonitorcounter = 0 # internal use
       self.internalmonitorid = 0 # internal use
+      self.monitorinterval = float(args.monitor_interval) # seconds between two resource samples
+      self.monitorthread = None # resource monitoring runs in a background thread
+      self.monitorstop = threading.Event()
+      # latest global resource sample (read by the backfill gate of the memory pressure control);
+      # the monitor thread replaces the dict as a whole so readers never see partial updates
+      self.global_resource_snapshot = {}
+      self.suspended = {} # backfill tasks stopped under memory pressure: task id -> list of stopped processes
+      if self.simulation == None:
+          self.doneindex = None # set of (directory, filename) of existing done files; built on first use
+      self.notifier = Notifier(args.webhook) if args.webhook != None else None
+      self.trace = None
+      if args.trace != None:
+          self.trace = TraceWriter(args.trace, self.simulation.clock if self.simulation != None else time.time)
+      self.coreallocator = None # pins tasks to cores (if requested)
+      self.numactl = None # path of numactl used to set the memory policy of pinned tasks
+      if args.cpu_affinity and not args.dry_run and self.simulation == None and self.workers == None:
+          self.coreallocator = CoreAllocator.from_system()
+          self.numactl = shutil.which('numactl')
+          actionlogger.info('Pinning tasks to cores; NUMA nodes ' + str({ n : format_cpulist(c) for n, c in self.coreallocator.nodes.items() }))
+      self.taskcgroups = None # per-task cgroups (if requested and permitted)
+      if args.task_cgroups and not args.dry_run and self.workers == None:
+          try:
+              self.taskcgroups = TaskCgroups()
+              actionlogger.info('Running tasks in cgroups below ' + self.taskcgroups.parent)
+          except OSError as e:
+              print ('Cannot use per-task cgroups (' + str(e) + '); falling back to process based accounting')
+              actionlogger.info('Cannot use per-task cgroups: ' + str(e))
+      self.sharedlocks = {} # global tasks this shard executes: task id -> file descriptor holding the lock
+      self.sharedwaiters = set() # global tasks executed by another shard which we are waiting for
+      self.requeued = [] # tasks to put back into the ready queue (the shard executing them gave up)
+
+    # connects to the worker agents; the resource limits become the sum of what they offer
+    def connect_workers(self, addresses):
+        from o2_dpg_workflow_worker import read_token
+        try:
+            token = read_token(self.args.worker_token_file)
+        except (OSError, ValueError) as e:
+            print ('Cannot read worker token: ' + str(e))
+            exit (1)
+        self.workers = []
+        for a in addresses:
+            try:
+                w = RemoteWorker(a, self.childevents, token)
+            except StopIteration:
+                print ('Cannot connect to worker ' + a + ': connection closed (wrong token?)')
+                exit (1)
+            except (OSError, ValueError, KeyError) as e:
+                print ('Cannot connect to worker ' + a + ': ' + str(e))
+                exit (1)
+            actionlogger.info('Connected to worker ' + a + ' on ' + w.host + ' offering cpu ' + str(w.cpu) + ' mem ' + str(w.mem))
+            self.workers.append(w)
+        self.cpulimit = sum(w.cpu for w in self.workers)
+        self.memlimit = sum(w.mem for w in self.workers)
+
+    # resource aware placement: the worker with the least CPU left over after
+    # placing the task (best fit, keeping large holes for large tasks)
+    def choose_worker(self, tid, backfill=False):
+        cpu = max(0., float(self.cpuperid[tid]))
+        mem = max(0., float(self.maxmemperid[tid]))
+        fitting = [ w for w in self.workers if w.fits(cpu, mem, 1.5 if backfill else 1.) ]
+        if len(fitting) == 0:
+            return None
+        return min(fitting, key=lambda w: w.cpu - w.cpubooked - cpu)
 
     def SIGHandler(self, signum, frame):
        # basically forcing shut down of all child processes
        actionlogger.info("Signal " + str(signum) + " caught")
+       # stopped processes would not react to termination
+       for tid in list(self.suspended.keys()):
+           self.resume_suspended(tid)
        try:
            procs = psutil.Process().children(recursive=True)
        except (psutil.NoSuchProcess):
@@ -412,6 +1635,11 @@ class WorkflowExecutor:
        except (psutil.AccessDenied, PermissionError):
            procs = getChildProcs(os.getpid())
 
+       if self.workers != None:
+           for w in self.workers:
+               for tid in list(w.tasks.keys()):
+                   w.kill(tid)
+
        for p in procs:
            actionlogger.info("Terminating " + str(p))
            try:
@@ -427,14 +1655,80 @@ class WorkflowExecutor:
            except (psutil.NoSuchProcess, psutil.AccessDenied):
              pass
 
+       # also catches processes which left the process tree
+       if self.taskcgroups != None:
+           self.taskcgroups.cleanup()
+       if self.trace != None:
+           self.trace.close()
+       if self.notifier != None:
+           self.notifier.close()
+
        exit (1)
 
-    def getallrequirements(self, t):
-        l=[]
-        for r in self.workflowspec['stages'][self.tasktoid[t]]['needs']:
-            l.append(r)
-            l=l+self.getallrequirements(r)
-        return l
+    # The expected cost of a task: its duration weighted by the fraction
+    # of the CPU and memory budget it books. Unknown resources (-1) don't count.
+    def task_cost(self, tid):
+        cpu = max(0., float(self.cpuperid[tid]))
+        mem = max(0., float(self.maxmemperid[tid]))
+        return self.taskdurations[tid] * (1. + cpu/self.cpulimit + mem/self.memlimit)
+
+    # Computes the scheduling weights (smaller is submitted first) according to a policy:
+    #  'timeframe'     : prefer to finish timeframes in order (the historic behaviour)
+    #  'critical-path' : prefer tasks heading the longest (cost-weighted) chain of dependents
+    #  'mixed'         : equal blend of normalized critical path and timeframe rank
+    def compute_task_weights(self, policy):
+        stages = self.workflowspec['stages']
+        if policy == 'timeframe':
+            return [ stages[tid]['timeframe'] for tid in range(len(stages)) ]
+
+        cost = [ self.task_cost(tid) for tid in range(len(stages)) ]
+        cpl = critical_path_lengths(self.graph, self.topological_orderings[0], cost)
+        if policy == 'critical-path':
+            weights = [ -c for c in cpl ]
+        else:
+            maxcpl = max(cpl) if len(cpl) > 0 else 1.
+            timeframes = sorted(set(s['timeframe'] for s in stages))
+            tfrank = { tf:i for i, tf in enumerate(timeframes) }
+            weights = [ -cpl[tid]/maxcpl + tfrank[stages[tid]['timeframe']]/len(timeframes) for tid in range(len(stages)) ]
+
+        for tid in range(len(stages)):
+            actionlogger.info("Critical path for " + self.idtotask[tid] + " is " + str(cpl[tid]) + " ; weight " + str(weights[tid]))
+        return weights
+
+    # Overrides the declared resource estimates with the ones learned from previous runs:
+    # memory becomes the peak PSS and CPU the mean usage, both scaled by a safety margin.
+    # This shrinks over-declared tasks while growing under-declared ones.
+    def apply_resource_history(self):
+        if self.args.resource_history == None:
+            print ('--use-resource-history requires --resource-history')
+            exit (1)
+        if self.resourcehistory == None:
+            return # could not be opened
+        margin = float(self.args.resource_history_margin)
+        estimates = self.resourcehistory.estimates()
+        for tid in range(len(self.taskuniverse)):
+            stage = self.workflowspec['stages'][tid]
+            e = estimates.get(ResourceHistory.task_key(stage['name'], stage['labels']))
+            if e == None:
+                continue
+            if e['pss'] != None:
+                self.maxmemperid[tid] = margin * e['pss']
+            if e['cpu'] != None:
+                self.cpuperid[tid] = margin * e['cpu']
+            if e['duration'] != None:
+                self.taskdurations[tid] = e['duration']
+            actionlogger.info('Using resource history for ' + stage['name'] + ': mem ' + str(self.maxmemperid[tid]) + ' cpu ' + str(self.cpuperid[tid]) + ' (declared mem ' + str(stage['resources']['mem']) + ' cpu ' + str(stage['resources']['cpu']) + ')')
+
+    # stores what a successfully finished task used in the resource history
+    def record_resource_history(self, tid):
+        if self.resourcehistory == None:
+            return
+        stage = self.workflowspec['stages'][tid]
+        m = self.taskmeasurements.get(tid)
+        pss = m['maxpss'] if m != None else None
+        cpu = m['cpusum'] / m['nsamples'] / 100. if m != None else None # percent to cores
+        duration = time.time() - self.tasksubmittime[tid]
+        self.resourcehistory.add(stage['name'], stage['labels'], pss, cpu, duration)
 
     def get_done_filename(self, tid):
         name = self.workflowspec['stages'][tid]['name']
@@ -446,6 +1740,8 @@ class WorkflowExecutor:
 
     # removes the done flag from tasks that need to be run again
     def remove_done_flag(self, listoftaskids):
+       if self.doneindex == None:
+           self.build_done_index()
        for tid in listoftaskids:
           done_filename = self.get_done_filename(tid)
           name=self.workflowspec['stages'][tid]['name']
@@ -455,39 +1751,122 @@ class WorkflowExecutor:
               print ("Marking task " + name + " as to be done again")
               if os.path.exists(done_filename) and os.path.isfile(done_filename):
                   os.remove(done_filename)
+          self.doneindex.discard((os.path.dirname(done_filename), os.path.basename(done_filename)))
       
+    # marks done tasks whose command, environment or inputs changed since they
+    # were run (according to the manifest) -- and everything depending on them -- to be done again
+    def remove_stale_done_flags(self):
+       stale = set()
+       for tid in self.graph.topological_order():
+          if tid in stale or not self.ok_to_skip(tid):
+              continue
+          reason = self.manifest.stale_reason(self.workflowspec['stages'][tid])
+          if reason != None:
+              actionlogger.info('Task ' + self.idtotask[tid] + ' is stale: ' + reason)
+              print ('Task ' + self.idtotask[tid] + ' is stale: ' + reason)
+              stale.update(find_all_dependent_tasks(self.possiblenexttask, tid))
+       self.remove_done_flag(sorted(stale))
+
     # submits a task as subprocess and records Popen instance
     def submit(self, tid, nice=os.nice(0)):
       actionlogger.debug("Submitting task " + str(self.idtotask[tid]) + " with nice value " + str(nice))
+      if self.simulation != None:
+          self.procstatus[tid]='Running'
+          self.nicevalues[tid]=nice
+          return self.simulation.start(tid)
+
       c = self.workflowspec['stages'][tid]['cmd']
       workdir = self.workflowspec['stages'][tid]['cwd']
-      if not workdir=='':
+      if not workdir=='' and not workdir in self.workdirs:
           if os.path.exists(workdir) and not os.path.isdir(workdir):
                   actionlogger.error('Cannot create working dir ... some other resource exists already')
                   return None
 
           if not os.path.isdir(workdir):
                   os.mkdir(workdir)
+          self.workdirs.add(workdir)
 
       self.procstatus[tid]='Running'
+      self.tasksubmittime[tid]=time.time()
+      if self.manifest != None:
+          self.taskfingerprints[tid]=self.manifest.fingerprint(self.workflowspec['stages'][tid])
       if args.dry_run:
           drycommand="echo \' " + str(self.scheduling_iteration) + " : would do " + str(self.workflowspec['stages'][tid]['name']) + "\'"
           return subprocess.Popen(['/bin/bash','-c',drycommand], cwd=workdir)
 
-      taskenv = os.environ.copy()
-      # add task specific environment
-      if self.workflowspec['stages'][tid].get('env')!=None:
-          taskenv.update(self.workflowspec['stages'][tid]['env'])
-
-      p = psutil.Popen(['/bin/bash','-c',c], cwd=workdir, env=taskenv)
-      try:
-          p.nice(nice)
-          self.nicevalues[tid]=nice
-      except (psutil.NoSuchProcess, psutil.AccessDenied):
-          actionlogger.error('Couldn\'t set nice value of ' + str(p.pid) + ' to ' + str(nice) + ' -- current value is ' + str(p.nice()))
-          self.nicevalues[tid]=os.nice(0)
+      if self.workers != None:
+          return self.submit_remote(tid, nice)
+
+      taskenv = self.task_environment(tid)
+
+      preexecs = [] # functions to run in the child before exec
+      if nice != os.nice(0):
+          increment = nice - os.nice(0)
+          preexecs.append(lambda : os.nice(increment))
+      if self.taskcgroups != None:
+          cgroup = self.taskcgroups.create(tid, float(self.cpuperid[tid]), float(self.maxmemperid[tid]))
+          if cgroup != None:
+              preexecs.append(TaskCgroups.joiner(cgroup))
+
+      command = ['/bin/bash','-c',c]
+      # tasks without declared CPU needs and backfill tasks stay unpinned; cores are kept for the real work
+      if self.coreallocator != None and float(self.cpuperid[tid]) > 0 and nice == os.nice(0):
+          allocation = self.coreallocator.allocate(tid, int(math.ceil(float(self.cpuperid[tid]))))
+          if allocation != None:
+              cpus, node = allocation
+              actionlogger.info('Pinning task ' + self.idtotask[tid] + ' to cpus ' + format_cpulist(cpus) + ' (NUMA node ' + str(node) + ')')
+              taskenv = dict(taskenv) # the cached environment is shared
+              taskenv['O2DPG_TASK_CPUSET'] = format_cpulist(cpus)
+              taskenv['O2DPG_TASK_NUMA_NODE'] = str(node) if node != None else ''
+              preexecs.append(lambda : os.sched_setaffinity(0, cpus))
+              if node != None and self.numactl != None:
+                  command = [self.numactl, '--preferred=' + str(node), '--'] + command
+          else:
+              actionlogger.info('No free cores for task ' + self.idtotask[tid] + '; not pinned')
+
+      # without anything to do in the child, Popen can take the fast (vfork/posix_spawn) path
+      preexec = None
+      if len(preexecs) > 0:
+          def preexec():
+              for f in preexecs:
+                  f()
+
+      launchstart = time.perf_counter()
+      p = psutil.Popen(command, cwd=workdir, env=taskenv, preexec_fn=preexec)
+      launch = time.perf_counter() - launchstart
+      self.nicevalues[tid]=nice
+      stage = self.workflowspec['stages'][tid]
+      actionlogger.debug('Launched ' + stage['name'] + ' as ' + str(p.pid) + ' in ' + '%.2f' % (1000.*launch) + ' ms')
+      metriclogger.info({'type':'task_start', 'name':stage['name'], 'label':stage['labels'], 'cpu':self.cpuperid[tid], 'mem':self.maxmemperid[tid], 'nice':nice, 'launch':launch})
       return p
 
+    # the environment of a task; built once per distinct task specific environment
+    def task_environment(self, tid):
+      env = self.workflowspec['stages'][tid].get('env')
+      key = tuple(sorted(env.items())) if env != None else ()
+      taskenv = self.envcache.get(key)
+      if taskenv == None:
+          taskenv = os.environ.copy()
+          # add task specific environment
+          if env != None:
+              taskenv.update({ k:str(v) for k, v in env.items() })
+          self.envcache[key] = taskenv
+      return taskenv
+
+    # sends a task to the best fitting worker agent
+    def submit_remote(self, tid, nice):
+      worker = self.choose_worker(tid, nice != os.nice(0))
+      if worker == None:
+          return None
+      stage = self.workflowspec['stages'][tid]
+      env = dict(stage.get('env', {}))
+      env['JOBUTILS_SKIPDONE'] = os.environ.get('JOBUTILS_SKIPDONE', '')
+      actionlogger.info('Placing task ' + stage['name'] + ' on worker ' + worker.address)
+      metriclogger.info({'type':'task_start', 'name':stage['name'], 'label':stage['labels'], 'cpu':self.cpuperid[tid], 'mem':self.maxmemperid[tid], 'nice':nice, 'worker':worker.address})
+      self.taskworker[tid] = worker
+      self.nicevalues[tid] = nice
+      return worker.run(tid, stage['cmd'], os.path.abspath(stage['cwd']), env, nice, max(0., float(self.cpuperid[tid])), max(0., float(self.maxmemperid[tid])))
+
     def ok_to_submit(self, tid, backfill=False):
       softcpufactor=1 
       softmemfactor=1
@@ -501,13 +1880,20 @@ class WorkflowExecutor:
           # analyse MEM
           okmem = (self.curmembooked + float(self.maxmemperid[tid]) <= self.memlimit)
           actionlogger.debug ('Condition check --normal-- for  ' + str(tid) + ':' + str(self.idtotask[tid]) + ' CPU ' + str(okcpu) + ' MEM ' + str(okmem))
+          if self.workers != None and okcpu and okmem:
+              return self.choose_worker(tid) != None
           return (okcpu and okmem)
       else:
           # not backfilling jobs which either take much memory or use lot's of CPU anyway
           # conditions are somewhat arbitrary and can be played with
-          if float(self.cpuperid[tid]) > 0.9*float(self.args.cpu_limit):
+          if float(self.cpuperid[tid]) > 0.9*self.cpulimit:
               return False
-          if float(self.maxmemperid[tid])/float(self.args.cpu_limit) >= 1900:
+          if float(self.maxmemperid[tid])/self.cpulimit >= 1900:
+              return False
+
+          # nothing new while the memory pressure control is holding back (stopped tasks keep their memory)
+          if self.args.mem_pressure_control and self.under_memory_pressure():
+              actionlogger.debug ('No backfill for ' + str(tid) + ':' + str(self.idtotask[tid]) + ' under memory pressure')
               return False
 
           # analyse CPU
@@ -516,28 +1902,112 @@ class WorkflowExecutor:
           # analyse MEM
           okmem = (self.curmembooked + self.curmembooked_backfill + float(self.maxmemperid[tid]) <= softmemfactor*self.memlimit)
           actionlogger.debug ('Condition check --backfill-- for  ' + str(tid) + ':' + str(self.idtotask[tid]) + ' CPU ' + str(okcpu) + ' MEM ' + str(okmem))
+          if self.workers != None and okcpu and okmem:
+              return self.choose_worker(tid, backfill=True) != None
           return (okcpu and okmem)
       return False
 
 
-    def ok_to_skip(self, tid):
+    # Scans every distinct working directory once for done files. This replaces
+    # stat calls per task and scheduling iteration (slow on shared filesystems).
+    def build_done_index(self):
+        self.doneindex = set()
+        directories = set(os.path.dirname(self.get_done_filename(tid)) for tid in range(len(self.taskuniverse)))
+        for d in directories:
+            try:
+                with os.scandir(d if d != '' else '.') as entries:
+                    for e in entries:
+                        if e.name.endswith('.log_done') and e.is_file():
+                            self.doneindex.add((d, e.name))
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                pass
+
+    # Global (timeframe=-1) tasks are common to all shards and must run only once. The shards
+    # synchronize via a file lock next to the done file: the shard holding it executes the task.
+    def is_shared_task(self, tid):
+        return self.shard != None and not self.args.dry_run and self.workflowspec['stages'][tid]['timeframe'] == -1
+
+    def get_lock_filename(self, tid):
+        return self.get_done_filename(tid)[:-len('_done')] + '_lock'
+
+    # tries to become the executing shard of a global task; True if we own it (or it turned out to be done)
+    def own_shared_task(self, tid):
+        if tid in self.sharedlocks:
+            return True
+        lockfile = self.get_lock_filename(tid)
+        os.makedirs(os.path.dirname(lockfile) or '.', exist_ok=True)
+        fd = os.open(lockfile, os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
         done_filename = self.get_done_filename(tid)
-        if os.path.exists(done_filename) and os.path.isfile(done_filename):
+        if os.path.exists(done_filename):
+            # finished by another shard in the meantime
+            actionlogger.info('Global task ' + self.idtotask[tid] + ' was done by another shard')
+            self.doneindex.add((os.path.dirname(done_filename), os.path.basename(done_filename)))
+            os.close(fd)
             return True
-        return False
+        actionlogger.info('Executing global task ' + self.idtotask[tid] + ' for all shards')
+        self.sharedlocks[tid] = fd
+        return True
+
+    def release_shared_task(self, tid):
+        fd = self.sharedlocks.pop(tid, None)
+        if fd != None:
+            os.close(fd)
+
+    # a process blocking until the shard executing a global task releases the lock;
+    # it books no resources
+    def wait_for_shared_task(self, tid):
+        actionlogger.info('Waiting for global task ' + self.idtotask[tid] + ' executed by another shard')
+        self.sharedwaiters.add(tid)
+        return psutil.Popen([sys.executable, '-c', 'import fcntl, sys; fcntl.flock(open(sys.argv[1], "a"), fcntl.LOCK_EX)', self.get_lock_filename(tid)])
 
+    def ok_to_skip(self, tid):
+        if self.doneindex == None:
+            self.build_done_index()
+        done_filename = self.get_done_filename(tid)
+        return (os.path.dirname(done_filename), os.path.basename(done_filename)) in self.doneindex
+
+    # Marks all tasks which are done, and whose requirements are all done too,
+    # as finished in one pass before the main loop starts
+    def skip_done_tasks(self, candidates):
+        done = [ False for _ in range(len(self.taskuniverse)) ]
+        skipped = []
+        for tid in self.topological_orderings[0]:
+            if self.ok_to_skip(tid) and all(done[p] for p in self.graph.predecessors[tid]):
+                done[tid] = True
+                skipped.append(tid)
+                self.procstatus[tid] = 'Done'
+        if len(skipped) > 0:
+            actionlogger.info('Skipping ' + str(len(skipped)) + ' tasks which are already done')
+            if self.trace != None:
+                for tid in skipped:
+                    self.trace.task_skipped(self.idtotask[tid])
+            candidates.bulk_finished(skipped)
+
+    # tries to submit ready tasks in priority order; taskcandidates is the
+    # ReadinessTracker and tasks which cannot be submitted are put back
     def try_job_from_candidates(self, taskcandidates, process_list, finished):
        self.scheduling_iteration = self.scheduling_iteration + 1
 
        # the ordinary process list part
-       initialcandidates=taskcandidates.copy()
-       for tid in initialcandidates:
+       notsubmitted = []
+       while len(taskcandidates) > 0:
+          tid = taskcandidates.pop()
           actionlogger.debug ("trying to submit " + str(tid) + ':' + str(self.idtotask[tid]))
+          if self.is_shared_task(tid) and not self.own_shared_task(tid):
+              # another shard executes it
+              self.process_list.append((tid, self.wait_for_shared_task(tid)))
+
           # check early if we could skip
           # better to do it here (instead of relying on taskwrapper)
-          if self.ok_to_skip(tid):
+          elif self.ok_to_skip(tid):
+              if self.trace != None:
+                  self.trace.task_skipped(self.idtotask[tid])
               finished.append(tid)
-              taskcandidates.remove(tid)
               break #---> we break in order to preserve some ordering (the next candidate tried should be daughters of skipped job) 
 
           elif (len(self.process_list) + len(self.backfill_process_list) < self.max_jobs_parallel) and self.ok_to_submit(tid):
@@ -546,15 +2016,19 @@ class WorkflowExecutor:
                 self.curmembooked+=float(self.maxmemperid[tid])
                 self.curcpubooked+=float(self.cpuperid[tid])
                 self.process_list.append((tid,p))
-                taskcandidates.remove(tid)
-                # minimal delay
-                time.sleep(0.1)
+                if self.trace != None:
+                    self.trace.task_started(tid, self.idtotask[tid])
+                if self.simulation != None:
+                    self.simulation.record_booking(self.curcpubooked + self.curcpubooked_backfill, self.curmembooked + self.curmembooked_backfill)
+            else:
+                notsubmitted.append(tid)
           else:
+             notsubmitted.append(tid)
              break #---> we break at first failure assuming some priority (other jobs may come in via backfill)
 
        # the backfill part for remaining candidates
-       initialcandidates=taskcandidates.copy()
-       for tid in initialcandidates:
+       while len(taskcandidates) > 0:
+          tid = taskcandidates.pop()
           actionlogger.debug ("trying to backfill submit " + str(tid) + ':' + str(self.idtotask[tid]))
 
           if (len(self.process_list) + len(self.backfill_process_list) < self.max_jobs_parallel) and self.ok_to_submit(tid, backfill=True):
@@ -563,32 +2037,227 @@ class WorkflowExecutor:
                 self.curmembooked_backfill+=float(self.maxmemperid[tid])
                 self.curcpubooked_backfill+=float(self.cpuperid[tid])
                 self.process_list.append((tid,p))
-                taskcandidates.remove(tid) #-> not sure about this one
-                # minimal delay
-                time.sleep(0.1)
+                if self.trace != None:
+                    self.trace.task_started(tid, self.idtotask[tid], backfill=True)
+                if self.simulation != None:
+                    self.simulation.record_booking(self.curcpubooked + self.curcpubooked_backfill, self.curmembooked + self.curmembooked_backfill)
+            else:
+                notsubmitted.append(tid)
           else:
-             continue
+             notsubmitted.append(tid)
+
+       for tid in notsubmitted:
+          taskcandidates.push(tid)
+
+    # Stages may declare how failures are retried:
+    #   'retry' : { 'max_attempts' : 3,      # attempts in total
+    #               'backoff' : 10,          # seconds before the first retry
+    #               'backoff_factor' : 2,    # growth of the delay with every further retry
+    #               'exit_codes' : [ ... ],  # retry only for these exit codes ...
+    #               'log_patterns' : [ ... ] # ... or if the task log matches one of these regular expressions }
+    # Without exit_codes and log_patterns every failure is retried.
+    # Returns the reason for a retry (None if the failure is final).
+    def retry_wanted(self, tid, returncode):
+        spec = self.workflowspec['stages'][tid].get('retry')
+        if spec == None or self.attempts.get(tid, 0) + 1 >= int(spec.get('max_attempts', 1)):
+            return None
+        exitcodes = spec.get('exit_codes')
+        patterns = spec.get('log_patterns')
+        if exitcodes == None and patterns == None:
+            return 'exit code ' + str(returncode)
+        if exitcodes != None and returncode in exitcodes:
+            return 'exit code ' + str(returncode)
+        if patterns != None:
+            logtail = self.read_log_tail(tid)
+            for pattern in patterns:
+                if re.search(pattern, logtail) != None:
+                    return 'log matches ' + pattern
+        return None
+
+    # the end of the log file of a task (by the taskwrapper convention <cwd>/<name>.log)
+    def read_log_tail(self, tid, size=1024*1024):
+        stage = self.workflowspec['stages'][tid]
+        try:
+            with open(stage['cwd'] + '/' + stage['name'] + '.log', 'rb') as fp:
+                fp.seek(0, os.SEEK_END)
+                fp.seek(max(0, fp.tell() - size))
+                return fp.read().decode(errors='replace')
+        except OSError:
+            return ''
+
+    # requeues a failed task (after its backoff) if its retry spec says so
+    def schedule_retry(self, tid, returncode):
+        reason = self.retry_wanted(tid, returncode) if self.draining == None else None
+        if reason == None:
+            return False
+        spec = self.workflowspec['stages'][tid]['retry']
+        attempt = self.attempts.get(tid, 0) + 1
+        self.attempts[tid] = attempt
+        delay = float(spec.get('backoff', 10)) * float(spec.get('backoff_factor', 2))**(attempt - 1)
+        heapq.heappush(self.retryqueue, (time.time() + delay, tid))
+        self.procstatus[tid] = 'ToDo'
+        message = 'Task ' + self.idtotask[tid] + ' failed (' + reason + '); retry ' + str(attempt) + ' in ' + '%.1f' % delay + 's'
+        print (message)
+        actionlogger.info(message)
+        metriclogger.info({'type':'task_retry', 'name':self.idtotask[tid], 'attempt':attempt, 'returncode':returncode, 'reason':reason, 'delay':delay})
+        self.notify(message)
+        return True
+
+    def retry_due(self):
+        return len(self.retryqueue) > 0 and self.retryqueue[0][0] <= time.time()
+
+    # seconds until the next retry is due (None if there is none)
+    def retry_timeout(self):
+        if len(self.retryqueue) == 0:
+            return None
+        return max(0., self.retryqueue[0][0] - time.time())
+
+    # moves retries which are due into the ready queue
+    def release_retries(self, candidates):
+        while self.retry_due():
+            _, tid = heapq.heappop(self.retryqueue)
+            actionlogger.info('Retrying task ' + self.idtotask[tid])
+            candidates.push(tid)
+
+    # After a failure nothing new is submitted. The running tasks were started alongside the
+    # failed ones and hence do not depend on them: they may finish within the grace period,
+    # so that their results (done files) are kept for a restart.
+    def start_drain(self, failingtasks, process_list):
+        self.draining = time.time() + float(self.args.drain_grace_period)
+        # pending retries would only start new work
+        self.failedtasks.extend([ tid for _, tid in self.retryqueue ])
+        self.retryqueue = []
+        for tid in list(self.suspended.keys()):
+            self.resume_suspended(tid)
+        remaining = [ self.idtotask[tid] for tid, _ in process_list ]
+        message = 'Failure in ' + str([ self.idtotask[tid] for tid in failingtasks ]) + '; draining ' + str(len(remaining)) \
+                  + ' running tasks for at most ' + str(self.args.drain_grace_period) + 's'
+        print (message)
+        actionlogger.info(message + ': ' + str(remaining))
+        self.notify(message)
+
+    # signals a task and its whole process tree
+    def terminate_task(self, proc, kill=False):
+        if isinstance(proc, RemoteTask):
+            proc.kill()
+            return
+        try:
+            procs = [ proc ] + proc.children(recursive=True)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            procs = [ proc ]
+        for p in procs:
+            try:
+                if kill:
+                    p.kill()
+                else:
+                    p.terminate()
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                pass
+
+    # ends draining (when nothing runs anymore or the grace period is over): whatever still
+    # runs is terminated (and killed if needed), then we report and exit
+    def finish_drain(self, process_list):
+        stopped = [ tid for tid, _ in process_list ]
+        for _, proc in process_list:
+            self.terminate_task(proc)
+        deadline = time.time() + 10
+        while any(proc.poll() == None for _, proc in process_list) and time.time() < deadline:
+            self.childevents.wait(0.5)
+        for _, proc in process_list:
+            if proc.poll() == None:
+                self.terminate_task(proc, kill=True)
+
+        print ('\n**** Pipeline stopped after failure *****')
+        print ('Failed tasks:                    ' + str([ self.idtotask[tid] for tid in self.failedtasks ]))
+        print ('Completed while draining:        ' + str([ self.idtotask[tid] for tid in self.drainfinished ]))
+        print ('Stopped after grace period:      ' + str([ self.idtotask[tid] for tid in stopped ]))
+        print ('Completed tasks keep their done state; rerunning the workflow resumes from there.')
+        actionlogger.info('Drain finished; completed ' + str(len(self.drainfinished)) + ' tasks, stopped ' + str(len(stopped)))
+        self.stop_pipeline_and_exit(process_list)
 
     def stop_pipeline_and_exit(self, process_list):
         # kill all remaining jobs
         for p in process_list:
-           p[1].kill()
+           try:
+              p[1].kill()
+           except (psutil.NoSuchProcess, ProcessLookupError):
+              pass
+        if self.taskcgroups != None:
+           self.taskcgroups.cleanup()
+        if self.trace != None:
+           self.trace.close()
+        if self.notifier != None:
+           self.notifier.close()
+
+        if self.resourcehistory != None:
+           self.resourcehistory.flush()
 
         exit(1)
 
-    def monitor(self, process_list):
-        self.internalmonitorcounter+=1
-        if self.internalmonitorcounter % 5 != 0:
-            return
+    def notify(self, message, key=None):
+        if self.notifier != None:
+            self.notifier.notify(message, key)
+
+    # statistics about the runner itself (used by the benchmark): startup phases,
+    # per task ready/submit/detection times and peak memory of the runner
+    def write_runner_stats(self, filename):
+        tasks = {}
+        for tid in range(len(self.taskuniverse)):
+            if tid in self.tasksubmittime or tid in self.taskreadytime:
+                tasks[self.idtotask[tid]] = { 'ready':self.taskreadytime.get(tid), 'submit':self.tasksubmittime.get(tid),
+                                              'detected':self.taskdetecttime.get(tid), 'cwd':self.workflowspec['stages'][tid]['cwd'] }
+        stats = { 'start':self.starttime, 'end':time.time(), 'ntasks':len(self.taskuniverse), 'phases':self.phasetimings,
+                  'peak_rss_mb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024., 'tasks':tasks }
+        with open(filename, 'w') as fp:
+            json.dump(stats, fp)
+
+    # starts resource monitoring in a background thread so that
+    # sampling cost never delays task submission
+    def start_monitor(self):
+        self.monitorthread = threading.Thread(target=self.monitor_loop, name='resource-monitor', daemon=True)
+        self.monitorthread.start()
+
+    def stop_monitor(self):
+        self.monitorstop.set()
+        if self.monitorthread != None:
+            self.monitorthread.join(timeout=2*self.monitorinterval)
+
+    def monitor_loop(self):
+        while not self.monitorstop.is_set():
+            try:
+                # work on a copy; the scheduler modifies the process list concurrently
+                self.monitor(list(self.process_list))
+            except Exception:
+                actionlogger.error('Exception in resource monitor: ' + traceback.format_exc())
+            self.monitorstop.wait(self.monitorinterval)
 
+    def monitor(self, process_list):
         self.internalmonitorid+=1
+        if self.taskcgroups != None:
+            self.taskcgroups.sweep()
 
         globalCPU=0.
         globalPSS=0.
         globalCPU_backfill=0.
         globalPSS_backfill=0.
         resources_per_task = {}
+        if self.procsampler != None:
+            self.procsampler.begin()
+        seenpids = set()
         for tid, proc in process_list:
+            if isinstance(proc, RemoteTask) or tid in self.sharedwaiters:
+                continue # not observable from here / not a task
+            # with a cgroup per task the kernel accounts for the whole process tree
+            usage = self.taskcgroups.usage(tid) if self.taskcgroups != None else None
+            if usage == None and self.procsampler != None:
+                usage = self.procsampler.task_usage(proc.pid)
+                if usage == None:
+                    continue # gone in the meantime
+            if usage != None:
+                io = { k:usage[k] for k in ['read_bytes', 'write_bytes'] if k in usage }
+                self.account_task_resources(tid, usage['cpu'], usage['uss'], usage['pss'], usage['swap'], resources_per_task, io)
+                continue
+
             # proc is Popen object
             pid=proc.pid
             if self.pid_to_files.get(pid)==None:
@@ -637,6 +2306,7 @@ class WorkflowExecutor:
 
                 # CPU part
                 # fetch existing proc or insert
+                seenpids.add(p.pid)
                 cachedproc = self.pid_to_psutilsproc.get(p.pid)
                 if cachedproc!=None:
                     try:
@@ -653,9 +2323,18 @@ class WorkflowExecutor:
                     except (psutil.NoSuchProcess, psutil.AccessDenied):
                         pass
 
-            resources_per_task[tid]={'iter':self.internalmonitorid, 'name':self.idtotask[tid], 'cpu':totalCPU, 'uss':totalUSS/1024./1024., 'pss':totalPSS/1024./1024, 'nice':proc.nice(), 'swap':totalSWAP, 'label':self.workflowspec['stages'][tid]['labels']}
-            metriclogger.info(resources_per_task[tid])
-            send_webhook(self.args.webhook, resources_per_task)
+            self.account_task_resources(tid, totalCPU, totalUSS/1024./1024., totalPSS/1024./1024, totalSWAP, resources_per_task)
+
+        # forget processes which are gone
+        for pid in list(self.pid_to_psutilsproc.keys()):
+            if not pid in seenpids:
+                del self.pid_to_psutilsproc[pid]
+        if self.procsampler != None:
+            self.procsampler.end()
+            # the sampler's own cost; should stay well below 1% of a core
+            metriclogger.info({'iter':self.internalmonitorid, 'name':'__monitor__', 'sampler_cpu':self.procsampler.cpucost, 'sampler_wall':self.procsampler.wallcost, 'nprocs':self.procsampler.nprocs})
+            if self.procsampler.cpucost > 0.01*self.monitorinterval:
+                actionlogger.info('Resource monitoring uses more than 1% of a core: ' + str(self.procsampler.cpucost) + 's per sample')
             
         for r in resources_per_task.values():
             if r['nice']==os.nice(0):
@@ -665,13 +2344,89 @@ class WorkflowExecutor:
                 globalCPU_backfill+=r['cpu']
                 globalPSS_backfill+=r['pss']
 
+        self.notify(str(resources_per_task), key='resources')
+
+        if self.trace != None:
+            for r in resources_per_task.values():
+                self.trace.counter('task ' + r['name'], {'cpu':r['cpu'], 'pss':r['pss']})
+            self.trace.counter('booked cpu', {'normal':self.curcpubooked, 'backfill':self.curcpubooked_backfill})
+            self.trace.counter('booked mem', {'normal':self.curmembooked, 'backfill':self.curmembooked_backfill})
+            self.trace.counter('measured cpu', {'normal':globalCPU/100., 'backfill':globalCPU_backfill/100.})
+            self.trace.counter('measured pss', {'normal':globalPSS, 'backfill':globalPSS_backfill})
+
+        # publish the latest sample to the scheduler
+        self.global_resource_snapshot = {'iter':self.internalmonitorid, 'cpu':globalCPU, 'pss':globalPSS, 'cpu_backfill':globalCPU_backfill, 'pss_backfill':globalPSS_backfill}
+
         if globalPSS > self.memlimit:
             metriclogger.info('*** MEMORY LIMIT PASSED !! ***')
-            # --> We could use this for corrective actions such as killing jobs currently back-filling
-            # (or better hibernating)
+
+        if self.args.mem_pressure_control and self.draining == None:
+            self.control_memory_pressure(process_list, resources_per_task, globalPSS + globalPSS_backfill)
+
+    # records one resource sample of a task (cpu in percent, memory in MB)
+    def account_task_resources(self, tid, cpu, uss, pss, swap, resources_per_task, extra={}):
+        resources_per_task[tid]={'iter':self.internalmonitorid, 'name':self.idtotask[tid], 'cpu':cpu, 'uss':uss, 'pss':pss, 'nice':self.nicevalues[tid], 'swap':swap, 'label':self.workflowspec['stages'][tid]['labels']}
+        resources_per_task[tid].update(extra)
+        metriclogger.info(resources_per_task[tid])
+        m = self.taskmeasurements.get(tid)
+        if m == None:
+            self.taskmeasurements[tid] = {'maxpss':pss, 'cpusum':cpu, 'nsamples':1}
+        else:
+            m['maxpss'] = max(m['maxpss'], pss)
+            m['cpusum'] += cpu
+            m['nsamples'] += 1
+
+    # true while backfill tasks are suspended or the last measured PSS is above the memory limit
+    def under_memory_pressure(self):
+        if len(self.suspended) > 0:
+            return True
+        sample = self.global_resource_snapshot
+        return len(sample) > 0 and sample['pss'] + sample['pss_backfill'] > self.memlimit
+
+    # Hibernates backfill tasks under memory pressure: when the measured PSS exceeds the
+    # memory limit, the least important running backfill task is stopped (SIGSTOP on its whole
+    # process tree). Stopped tasks are continued one by one (most important first) once the
+    # PSS fell below the low-water mark, or when nothing else is running anymore (the memory
+    # of stopped tasks stays resident). At most one action is taken per monitoring sample.
+    def control_memory_pressure(self, process_list, resources_per_task, totalPSS):
+        lowwater = float(self.args.mem_low_water) * self.memlimit
+        active = [ tid for tid, p in process_list if self.suspended.get(tid) == None and not isinstance(p, RemoteTask) ]
+        backfilling = [ tid for tid in active if self.nicevalues[tid] != os.nice(0) ]
+        # stopping the only active task would not help anyone
+        if totalPSS > self.memlimit and len(backfilling) > 0 and len(active) > 1:
+            tid = max(backfilling, key=lambda t: self.taskweights[t])
+            proc = [ p for t, p in process_list if t == tid ][0]
+            try:
+                procs = [ proc ] + proc.children(recursive=True)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                return
+            stopped = []
+            for p in procs:
+                try:
+                    p.suspend()
+                    stopped.append(p)
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    pass
+            self.suspended[tid] = stopped
+            pss = resources_per_task[tid]['pss'] if tid in resources_per_task else 0.
+            actionlogger.info('Suspending backfill task ' + self.idtotask[tid] + ' due to memory pressure')
+            metriclogger.info({'iter':self.internalmonitorid, 'action':'suspend', 'name':self.idtotask[tid], 'pss':pss, 'globalpss':totalPSS, 'memlimit':self.memlimit})
+
+        elif len(self.suspended) > 0 and (totalPSS < lowwater or len(active) == 0):
+            tid = min(self.suspended.keys(), key=lambda t: self.taskweights[t])
+            self.resume_suspended(tid)
+            metriclogger.info({'iter':self.internalmonitorid, 'action':'resume', 'name':self.idtotask[tid], 'globalpss':totalPSS, 'lowwater':lowwater})
+
+    def resume_suspended(self, tid):
+        procs = self.suspended.pop(tid, [])
+        actionlogger.info('Resuming backfill task ' + self.idtotask[tid])
+        for p in reversed(procs):
+            try:
+                p.resume()
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                pass
 
     def waitforany(self, process_list, finished):
-       failuredetected = False
        failingpids = []
        failingtasks = []
        if len(process_list)==0:
@@ -683,7 +2438,24 @@ class WorkflowExecutor:
           if not self.args.dry_run:
               returncode = p[1].poll()
           if returncode!=None:
+            self.taskdetecttime[p[0]] = time.time()
+          if returncode!=None and p[0] in self.sharedwaiters:
+            self.sharedwaiters.discard(p[0])
+            process_list.remove(p)
+            if os.path.exists(self.get_done_filename(p[0])):
+                actionlogger.info ('Global task ' + str(p[0])+':'+str(self.idtotask[p[0]]) + ' done by another shard')
+                self.procstatus[p[0]]='Done'
+                finished.append(p[0])
+            else:
+                # the executing shard failed or went away; try ourselves
+                actionlogger.info ('Global task ' + str(p[0])+':'+str(self.idtotask[p[0]]) + ' not done by another shard; requeuing')
+                self.requeued.append(p[0])
+
+          elif returncode!=None:
             actionlogger.info ('Task ' + str(pid) + ' ' + str(p[0])+':'+str(self.idtotask[p[0]]) + ' finished with status ' + str(returncode))
+            if p[0] in self.tasksubmittime and not self.args.dry_run:
+                metriclogger.info({'type':'task_end', 'name':self.idtotask[p[0]], 'returncode':returncode, 'duration':self.taskdetecttime[p[0]] - self.tasksubmittime[p[0]]})
+            self.release_shared_task(p[0])
             # account for cleared resources
             if self.nicevalues[p[0]]==os.nice(0):
                 self.curmembooked-=float(self.maxmemperid[p[0]])
@@ -691,23 +2463,58 @@ class WorkflowExecutor:
             else:
                 self.curmembooked_backfill-=float(self.maxmemperid[p[0]])
                 self.curcpubooked_backfill-=float(self.cpuperid[p[0]])
+            if self.trace != None:
+                self.trace.task_finished(p[0], self.idtotask[p[0]], returncode, {'nice':self.nicevalues[p[0]], 'cpu':self.cpuperid[p[0]], 'mem':self.maxmemperid[p[0]]})
+            if self.taskcgroups != None:
+                self.taskcgroups.remove(p[0])
+            if self.coreallocator != None:
+                self.coreallocator.release(p[0])
+            worker = self.taskworker.pop(p[0], None)
+            if worker != None:
+                worker.release(p[0], max(0., float(self.cpuperid[p[0]])), max(0., float(self.maxmemperid[p[0]])))
+            self.taskreturncode[p[0]]=returncode
+            process_list.remove(p)
+            if returncode!=0 and self.draining == None and self.retry_wanted(p[0], returncode) != None:
+               failingtasks.append(p[0]) # decided (and requeued) below
+               continue
             self.procstatus[p[0]]='Done'
             finished.append(p[0])
-            process_list.remove(p)
             if returncode!=0:
-               failuredetected = True
                failingpids.append(pid)
                failingtasks.append(p[0])
+            elif not self.args.dry_run and self.simulation == None:
+               if self.draining != None:
+                   self.drainfinished.append(p[0])
+               self.record_resource_history(p[0])
+               if self.manifest != None:
+                   self.manifest.record(self.workflowspec['stages'][p[0]], self.taskfingerprints[p[0]])
     
-       if failuredetected and self.stoponfailure:
+       failingtasks = [ tid for tid in failingtasks if not self.schedule_retry(tid, self.taskreturncode[tid]) ]
+       self.failedtasks.extend(failingtasks)
+       if len(failingtasks) > 0 and self.stoponfailure and self.draining == None:
           actionlogger.info('Stoping pipeline due to failure in stages with PID ' + str(failingpids))
           # self.analyse_files_and_connections()
           self.cat_logfiles_tostdout(failingtasks)
 
-          self.stop_pipeline_and_exit(process_list)
+          if float(self.args.drain_grace_period) <= 0:
+              self.stop_pipeline_and_exit(process_list)
+          self.start_drain(failingtasks, process_list)
 
-       # empty finished means we have to wait more        
-       return len(finished)==0
+       if len(failingtasks) > 0 and not self.stoponfailure:
+          # keep going: the failed tasks are not finished for their dependents, which are poisoned
+          self.cat_logfiles_tostdout(failingtasks)
+          for tid in failingtasks:
+             finished.remove(tid)
+             poisoned = [ d for d in find_all_dependent_tasks(self.possiblenexttask, tid) if d != tid and not d in self.poisoned ]
+             self.poisoned.extend(poisoned)
+             message = 'Task ' + self.idtotask[tid] + ' failed; not running ' + str(len(poisoned)) + ' dependent tasks'
+             print (message)
+             actionlogger.info(message + ': ' + str([ self.idtotask[d] for d in poisoned ]))
+             self.notify(message)
+
+       # empty finished means we have to wait more (unless nothing is running anymore, e.g.
+       # when the last running task failed with --keep-going)
+       return len(finished)==0 and len(self.requeued)==0 and not self.retry_due() and len(process_list) > 0
 
     def cat_logfiles_tostdout(self, taskids):
         # In case of errors we can cat the logfiles for this taskname
@@ -771,14 +2578,6 @@ class WorkflowExecutor:
             print('Exception during intersect outer')
             pass
 
-    def is_good_candidate(self, candid, finishedtasks):
-        if self.procstatus[candid] != 'ToDo':
-            return False
-        needs = set([self.tasktoid[t] for t in self.taskneeds[self.idtotask[candid]]])
-        if set(finishedtasks).intersection(needs) == needs:
-            return True
-        return False
-
     def emit_code_for_task(self, tid, lines):
         actionlogger.debug("Submitting task " + str(self.idtotask[tid]))
         taskspec = self.workflowspec['stages'][tid]
@@ -838,7 +2637,7 @@ class WorkflowExecutor:
             self.produce_script(args.produce_script)
             exit (0)
 
-        if args.rerun_from:
+        if args.rerun_from and self.simulation == None:
           reruntaskfound=False
           for task in self.workflowspec['stages']:
               taskname=task['name']
@@ -850,58 +2649,77 @@ class WorkflowExecutor:
               print('No task matching ' + args.rerun_from + ' found; cowardly refusing to do anything ')
               exit (1)
 
+        if self.manifest != None and self.simulation == None:
+            self.remove_stale_done_flags()
+
         # *****************
         # main control loop
         # *****************
-        currenttimeframe=1
-        candidates = [ tid for tid in self.possiblenexttask[-1] ]
+        # ready queue with all tasks whose requirements are fulfilled
+        t0 = time.perf_counter()
+        candidates = ReadinessTracker(self.graph, self.taskweights)
+        self.skip_done_tasks(candidates)
+        self.phasetimings['done_check'] = time.perf_counter() - t0
+        now = time.time()
+        for tid in candidates.candidates():
+            self.taskreadytime[tid] = now
 
         self.process_list=[] # list of tuples of nodes ids and Popen subprocess instances
+        if not args.dry_run and self.simulation == None:
+            self.start_monitor()
 
-        finishedtasks=[]
         try:
 
             while True:
-                # sort candidate list according to task weights
-                candidates = [ (tid, self.taskweights[tid]) for tid in candidates ]
-                candidates.sort(key=lambda tup: tup[1])
-                # remove weights
-                candidates = [ tid for tid,_ in candidates ]
-
                 finished = []
-                actionlogger.debug('Sorted current candidates: ' + str([(c,self.idtotask[c]) for c in candidates]))
-                self.try_job_from_candidates(candidates, self.process_list, finished)
-                if len(candidates) > 0 and len(self.process_list) == 0:
+                if self.draining != None:
+                    # no new work after a failure
+                    if len(self.process_list) == 0:
+                        self.finish_drain(self.process_list)
+                else:
+                    self.release_retries(candidates)
+                    if len(candidates) == 0 and len(self.process_list) == 0 and len(self.retryqueue) > 0:
+                        # nothing to do but waiting for a retry
+                        self.childevents.wait(self.retry_timeout())
+                        continue
+                    actionlogger.debug('Sorted current candidates: ' + str([(c,self.idtotask[c]) for c in candidates.candidates()]))
+                    self.try_job_from_candidates(candidates, self.process_list, finished)
+                if len(candidates) > 0 and len(self.process_list) == 0 and len(finished) == 0:
                     actionlogger.info("Not able to make progress: Nothing scheduled although non-zero candidate set")
-                    send_webhook(self.args.webhook,"Unable to make further progress: Quitting")
+                    self.notify("Unable to make further progress: Quitting")
                     break
             
                 finished_from_started = []
                 while self.waitforany(self.process_list, finished_from_started):
-                    if not args.dry_run:
-                        self.monitor(self.process_list) #  ---> make async to normal operation?
-                        time.sleep(1) # <--- make this incremental (small wait at beginning)
+                    # sleep until a child finishes
+                    if self.simulation != None:
+                        self.simulation.advance(self.process_list, self.curcpubooked + self.curcpubooked_backfill)
+                    elif self.draining != None:
+                        if time.time() >= self.draining:
+                            self.finish_drain(self.process_list)
+                        self.childevents.wait(self.draining - time.time())
+                    elif not args.dry_run:
+                        self.childevents.wait(self.retry_timeout())
                     else:
-                        time.sleep(0.001)
+                        self.childevents.wait(0.001)
 
                 finished = finished + finished_from_started
                 actionlogger.debug("finished now :" + str(finished_from_started))
-                finishedtasks=finishedtasks + finished
+                for tid in self.requeued:
+                    candidates.push(tid)
+                self.requeued = []
     
                 # someone returned
-                # new candidates
+                # new candidates are the dependents which have all requirements done
+                now = time.time()
                 for tid in finished:
-                    if self.possiblenexttask.get(tid)!=None:
-                        potential_candidates=list(self.possiblenexttask[tid])
-                        for candid in potential_candidates:
-                        # try to see if this is really a candidate:
-                            if self.is_good_candidate(candid, finishedtasks) and candidates.count(candid)==0:
-                                candidates.append(candid)
+                    for d in candidates.task_finished(tid):
+                        self.taskreadytime[d] = now
     
-                actionlogger.debug("New candidates " + str( candidates))
-                send_webhook(self.args.webhook, "New candidates " + str(candidates))
+                actionlogger.debug("New candidates " + str(candidates.candidates()))
+                self.notify("New candidates " + str(candidates.candidates()), key='candidates')
     
-                if len(candidates)==0 and len(self.process_list)==0:
+                if len(candidates)==0 and len(self.process_list)==0 and len(self.retryqueue)==0 and self.draining == None:
                    break
         except Exception as e:
             exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -912,6 +2730,24 @@ class WorkflowExecutor:
 
             self.SIGHandler(0,0)
 
+        self.stop_monitor()
+        if self.taskcgroups != None:
+            self.taskcgroups.cleanup()
+        if self.trace != None:
+            self.trace.close()
+        if self.notifier != None:
+            self.notifier.close()
+        if self.resourcehistory != None:
+            self.resourcehistory.flush()
+        if self.simulation != None:
+            self.simulation.report(self.cpulimit)
+        if args.runner_stats != None:
+            self.write_runner_stats(args.runner_stats)
+        if len(self.failedtasks) > 0:
+            print ('\n**** Pipeline done with failures *****')
+            print ('Failed tasks:                    ' + str([ self.idtotask[tid] for tid in self.failedtasks ]))
+            print ('Not run (depend on failed task): ' + str([ self.idtotask[tid] for tid in self.poisoned ]))
+            exit(1)
         print ('\n**** Pipeline done *****\n')
         # self.analyse_files_and_connections()
 
@@ -925,24 +2761,61 @@ parser = argparse.ArgumentParser(description='Parallel execution of a (O2-DPG) D
 parser.add_argument('-f','--workflowfile', help='Input workflow file name', required=True)
 parser.add_argument('-jmax','--maxjobs', help='Number of maximal parallel tasks.', default=100)
 parser.add_argument('--dry-run', action='store_true', help='Show what you would do.')
+parser.add_argument('--simulate', nargs='?', const='', help='Simulate the scheduling on a virtual clock instead of executing tasks and report makespan, \
+                    utilisation and peak booked memory. Task durations are taken from the given profile (json or pipeline_metric.log), \
+                    from <task>.log_time files or the resource history, or a default of ' + str(SIMULATION_DEFAULT_DURATION) + 's.')
 parser.add_argument('--visualize-workflow', action='store_true', help='Saves a graph visualization of workflow.')
 parser.add_argument('--target-labels', nargs='+', help='Runs the pipeline by target labels (example "TPC" or "DIGI").\
                     This condition is used as logical AND together with --target-tasks.', default=[])
 parser.add_argument('-tt','--target-tasks', nargs='+', help='Runs the pipeline by target tasks (example "tpcdigi"). By default everything in the graph is run. Regular expressions supported.', default=["*"])
+parser.add_argument('--no-dag-cache', action='store_true', help='Do not read or write the compiled workflow cache (<workflowfile>.dagcache).')
 parser.add_argument('--produce-script', help='Produces a shell script that runs the workflow in serialized manner and quits.')
 parser.add_argument('--rerun-from', help='Reruns the workflow starting from given task (or pattern). All dependent jobs will be rerun.')
 parser.add_argument('--list-tasks', help='Simply list all tasks by name and quit.', action='store_true')
 
-parser.add_argument('--mem-limit', help='Set memory limit as scheduling constraint', default=max_system_mem)
+parser.add_argument('--scheduling-policy', help='Order in which ready tasks are submitted: timeframe-first, by critical path length \
+                    (weighted by expected duration and declared resources) or a mix of both.', choices=['timeframe', 'critical-path', 'mixed'], default='timeframe')
+parser.add_argument('--mem-limit', help='Set memory limit (MB) as scheduling constraint', default=max_system_mem/1024./1024.)
 parser.add_argument('--cpu-limit', help='Set CPU limit (core count)', default=8)
 parser.add_argument('--cgroup', help='Execute pipeline under a given cgroup (e.g., 8coregrid) emulating resource constraints. This m\
 ust exist and the tasks file must be writable to with the current user.')
+parser.add_argument('--cpu-affinity', action='store_true', help='Pin each task to its own set of cores (sized by its declared cpu), preferring contiguous cores \
+                    of a single NUMA node (with numactl --preferred memory policy if available). Tasks declaring no cpu and backfill tasks are not pinned. The assignment is exported as O2DPG_TASK_CPUSET and O2DPG_TASK_NUMA_NODE.')
+parser.add_argument('--task-cgroups', action='store_true', help='Run each task in its own cgroup (v2) limited to its declared resources and account resources via the cgroup. \
+                    Falls back to process based accounting if cgroups cannot be created.')
+parser.add_argument('--monitor-interval', help='Time interval (in seconds) between two resource monitoring samples.', default=5)
+parser.add_argument('--resource-history', help='sqlite file in which measured task resources (peak PSS, mean CPU, duration) are recorded across runs.')
+parser.add_argument('--use-resource-history', action='store_true', help='Replace declared task resources by the estimates learned in --resource-history.')
+parser.add_argument('--resource-history-margin', help='Safety factor applied to learned resource estimates.', default=1.2)
+parser.add_argument('--mem-pressure-control', action='store_true', help='Suspend backfill tasks when the measured memory exceeds --mem-limit \
+                    and resume them below the low-water mark. No backfill tasks are started meanwhile.')
+parser.add_argument('--mem-low-water', help='Fraction of --mem-limit below which suspended backfill tasks are resumed.', default=0.9)
+parser.add_argument('--manifest', help='File recording command, environment and input state of finished tasks. Done tasks which became stale \
+                    (and everything depending on them) are rerun.')
+parser.add_argument('--manifest-checksums', action='store_true', help='Track declared inputs by content hash instead of size and modification time.')
+parser.add_argument('--workers', help='Comma separated addresses (host:port or unix:/path) of o2_dpg_workflow_worker.py agents to execute tasks on. \
+                    CPU and memory limits become the sum of what the workers offer.')
+parser.add_argument('--worker-token-file', help='File with the secret shared with the workers (see o2_dpg_workflow_worker.py --token-file).', default='.o2dpg_worker_token')
+parser.add_argument('--shard', help='Run only shard i of N (given as i/N, i=0..N-1): every N-th timeframe starting with the i-th one. \
+                    Global tasks are executed by one shard only; the others wait for them. Meant for N identical jobs on a shared filesystem.')
+parser.add_argument('--trace', help='Write a trace of task execution and resources (Chrome trace event format; open in Perfetto or chrome://tracing) to this file.')
+parser.add_argument('--runner-stats', help='Write timing statistics of the runner itself (startup phases, task ready/submit/detection times, peak RSS) as json to this file.')
+parser.add_argument('--drain-grace-period', help='After a task failed, nothing new is started and the running tasks \
+                    may finish within this many seconds (so a failing job may take up to this long to exit). 0 stops everything immediately.', default=300)
+parser.add_argument('-k', '--keep-going', action='store_true', help='Continue after a task failed (like make -k): only the tasks depending on it are not run, \
+                    everything else runs to completion. Failed and skipped tasks are summarized at the end (exit code 1).')
 parser.add_argument('--stdout-on-failure', action='store_true', help='Print log files of failing tasks to stdout,')
-parser.add_argument('--webhook', help=argparse.SUPPRESS) # log some infos to this webhook channel
+parser.add_argument('--webhook', help=argparse.SUPPRESS) # log some infos to this webhook channel (http(s)://, file: or unix:)
 
 args = parser.parse_args()
 print (args)
 
+if args.shard!=None:
+    # shards typically share the working directory
+    shardsuffix = '_shard' + args.shard.split('/')[0]
+    set_log_file(actionlogger, 'pipeline_action' + shardsuffix + '.log')
+    set_log_file(metriclogger, 'pipeline_metric' + shardsuffix + '.log')
+
 if args.cgroup!=None:
     myPID=os.getpid()
     command="echo " + str(myPID) + " > /sys/fs/cgroup/cpuset/"+args.cgroup+"/tasks"
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+# Benchmark of the overhead of o2_dpg_workflow_runner.py itself.
+#
+# Synthetic workflows shaped like the output of o2dpg_sim_workflow.py (a global
+# background simulation followed by a chain of signal simulation, digitization,
+# reconstruction and AOD tasks per timeframe) are generated for a number of
+# timeframes and executed with trivial (or sleep) commands. Measured are:
+#   - time to load, filter and analyse the workflow (per phase)
+#   - scheduling latency: time from a task becoming ready until it is submitted
+#   - wakeup latency: time from a task exiting until the runner notices
+#   - makespan, throughput and peak RSS of the runner
+# Results are written as json so that they can be compared across commits:
+#
+#   o2_dpg_workflow_runner_benchmark.py -o before.json
+#   ... change the runner ...
+#   o2_dpg_workflow_runner_benchmark.py -o after.json --compare before.json
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'o2_dpg_workflow_runner.py')
+
+# (name, needs) of the tasks of one timeframe; names get the timeframe as suffix
+TIMEFRAME_TASKS = [
+    ('gensgnconf', []),
+    ('sgnsim', ['gensgnconf', 'bkgsim']),
+    ('linkGRP', ['bkgsim']),
+    ('digicontext', ['sgnsim', 'linkGRP']),
+    ('tpcdigi', ['digicontext']),
+    ('trddigi', ['digicontext']),
+    ('itsdigi', ['digicontext']),
+    ('tofdigi', ['digicontext']),
+    ('ft0digi', ['digicontext']),
+    ('tpcclusterpart1', ['tpcdigi']),
+    ('tpcclusterpart2', ['tpcdigi']),
+    ('tpcclustermerge', ['tpcclusterpart1', 'tpcclusterpart2']),
+    ('tpcreco', ['tpcclustermerge']),
+    ('itsreco', ['itsdigi']),
+    ('ft0reco', ['ft0digi']),
+    ('itstpcMatch', ['tpcreco', 'itsreco']),
+    ('trdreco', ['trddigi', 'itstpcMatch', 'tpcreco', 'itsreco']),
+    ('tofmatch', ['itstpcMatch', 'tofdigi']),
+    ('toftpcmatch', ['tofmatch', 'tpcreco']),
+    ('pvfinder', ['itstpcMatch', 'ft0reco', 'toftpcmatch']),
+    ('aod', ['tpcreco', 'itsreco', 'ft0reco', 'itstpcMatch', 'tofmatch', 'toftpcmatch', 'pvfinder', 'trdreco'])
+]
+
+def make_command(name, sleep):
+    payload = 'sleep ' + str(sleep) if sleep > 0 else 'true'
+    # the exit time is taken by bash itself (no extra process)
+    return payload + ' ; echo ${EPOCHREALTIME} > ' + name + '.exit_time'
+
+def make_task(name, needs, tf, sleep):
+    return { 'name':name, 'cmd':make_command(name, sleep), 'needs':needs, 'resources':{ 'cpu':1, 'mem':10 },
+             'timeframe':tf, 'labels':[], 'cwd':'tf' + str(tf) if tf > 0 else './' }
+
+def generate_workflow(ntimeframes, sleep):
+    stages = [ make_task('bkgsim', [], -1, sleep) ]
+    for tf in range(1, ntimeframes + 1):
+        suffix = lambda n : n if n == 'bkgsim' else n + '_' + str(tf)
+        for name, needs in TIMEFRAME_TASKS:
+            stages.append(make_task(suffix(name), [ suffix(n) for n in needs ], tf, sleep))
+    return { 'stages':stages }
+
+def distribution(values):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    pick = lambda q : values[min(len(values) - 1, int(q*len(values)))]
+    return { 'mean':sum(values)/len(values), 'median':pick(0.5), 'p95':pick(0.95), 'max':values[-1], 'n':len(values) }
+
+def read_exit_time(workdir, task):
+    try:
+        with open(os.path.join(workdir, task['cwd'], task['name'] + '.exit_time')) as fp:
+            return float(fp.read().strip().replace(',', '.'))
+    except (OSError, ValueError):
+        return None
+
+def run_benchmark(ntimeframes, args):
+    workdir = tempfile.mkdtemp(prefix='o2dpg_benchmark_')
+    try:
+        workflow = generate_workflow(ntimeframes, args.sleep)
+        with open(os.path.join(workdir, 'workflow.json'), 'w') as fp:
+            json.dump(workflow, fp)
+        command = [ sys.executable, RUNNER, '-f', 'workflow.json', '--runner-stats', 'runner_stats.json',
+                    '--cpu-limit', str(args.cpu_limit), '-jmax', str(args.jmax) ] + args.runner_args
+        start = time.time()
+        result = subprocess.run(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        walltime = time.time() - start
+        if result.returncode != 0:
+            print ('Runner failed for ' + str(ntimeframes) + ' timeframes: ' + result.stderr.decode())
+            return None
+        with open(os.path.join(workdir, 'runner_stats.json')) as fp:
+            stats = json.load(fp)
+
+        schedulinglatency = []
+        wakeuplatency = []
+        for task in workflow['stages']:
+            t = stats['tasks'].get(task['name'])
+            if t == None:
+                continue
+            if t['ready'] != None and t['submit'] != None:
+                schedulinglatency.append(t['submit'] - t['ready'])
+            exittime = read_exit_time(workdir, task)
+            if exittime != None and t['detected'] != None:
+                wakeuplatency.append(t['detected'] - exittime)
+
+        return { 'timeframes':ntimeframes, 'ntasks':len(workflow['stages']), 'walltime':walltime,
+                 'makespan':stats['end'] - stats['start'], 'throughput':len(workflow['stages'])/(stats['end'] - stats['start']),
+                 'phases':stats['phases'], 'peak_rss_mb':stats['peak_rss_mb'],
+                 'scheduling_latency':distribution(schedulinglatency), 'wakeup_latency':distribution(wakeuplatency) }
+    finally:
+        if args.keep:
+            print ('Keeping ' + workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(RUNNER), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def summary(r):
+    ms = lambda d : '%8.2f' % (1000.*d['median']) if d != None else '       -'
+    loadtime = sum(r['phases'].values())
+    return ('%6d' % r['timeframes'] + '%8d' % r['ntasks'] + '%10.2f' % r['makespan'] + '%10.1f' % r['throughput']
+            + '%10.3f' % loadtime + ms(r['scheduling_latency']) + ms(r['wakeup_latency']) + '%9.1f' % r['peak_rss_mb'])
+
+def compare(results, reference):
+    byframes = { r['timeframes']:r for r in reference['results'] if r != None }
+    print ('\nComparison to ' + str(reference['meta'].get('commit')) + ' (ratio new/old)')
+    for r in results:
+        old = byframes.get(r['timeframes']) if r != None else None
+        if old == None:
+            continue
+        ratio = lambda new, ref : '%7.2f' % (new/ref) if ref > 0 else '      -'
+        median = lambda d : d['median'] if d != None else 0.
+        print ('%6d' % r['timeframes'] + '  makespan ' + ratio(r['makespan'], old['makespan'])
+               + '  load ' + ratio(sum(r['phases'].values()), sum(old['phases'].values()))
+               + '  sched ' + ratio(median(r['scheduling_latency']), median(old['scheduling_latency']))
+               + '  wakeup ' + ratio(median(r['wakeup_latency']), median(old['wakeup_latency']))
+               + '  rss ' + ratio(r['peak_rss_mb'], old['peak_rss_mb']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the overhead of the O2DPG workflow runner on synthetic workflows.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--timeframes', nargs='+', type=int, help='Workflow sizes (number of timeframes) to benchmark.', default=[1, 10, 100, 1000])
+    parser.add_argument('--sleep', type=float, help='Duration (seconds) of every task; 0 runs trivial commands.', default=0)
+    parser.add_argument('--cpu-limit', help='CPU limit passed to the runner (every task books one core).', default=32)
+    parser.add_argument('--jmax', help='Maximal number of parallel tasks passed to the runner.', default=100)
+    parser.add_argument('--runner-args', nargs=argparse.REMAINDER, help='Further arguments for the runner.', default=[])
+    parser.add_argument('-o', '--output', help='json file to store the results in.', default='runner_benchmark.json')
+    parser.add_argument('--compare', help='json file of a previous benchmark to compare with.')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directories.')
+    args = parser.parse_args()
+
+    print ('   TFs   tasks  makespan   tasks/s   load[s] sched[ms] wake[ms]  RSS[MB]')
+    results = []
+    for n in args.timeframes:
+        r = run_benchmark(n, args)
+        results.append(r)
+        if r != None:
+            print (summary(r))
+
+    meta = { 'commit':git_commit(), 'time':time.time(), 'host':platform.node(), 'python':platform.python_version(),
+             'cpus':os.cpu_count(), 'args':vars(args) }
+    with open(args.output, 'w') as fp:
+        json.dump({ 'meta':meta, 'results':results }, fp, indent=1)
+
+    if args.compare != None:
+        with open(args.compare) as fp:
+            compare(results, json.load(fp))
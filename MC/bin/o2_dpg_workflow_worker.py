@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+# A worker agent for o2_dpg_workflow_runner.py.
+#
+# The worker listens on a TCP port or a unix socket and waits for a coordinator
+# (a workflow runner started with --workers) to connect. It advertises its resources
+# (CPU cores, memory in MB) and then executes the tasks it is sent in the given working
+# directory, which is expected to be on a filesystem shared with the coordinator.
+#
+# Whoever is accepted as coordinator can run arbitrary commands as the owner of the worker.
+# Coordinators therefore have to prove that they know a shared secret: a token kept in a
+# file only readable by its owner (--token-file, typically on the shared filesystem; created
+# by the worker if it does not exist). The worker sends a random challenge, the coordinator
+# answers with the HMAC-SHA256 of it keyed with the token. Without a host, TCP addresses bind
+# to the loopback interface only.
+#
+# Messages are newline separated json objects:
+#   worker -> coordinator : {'type':'challenge', 'nonce':...}
+#   coordinator -> worker : {'type':'auth', 'digest':...}
+#   worker -> coordinator : {'type':'hello', 'host':..., 'cpu':..., 'mem':...}
+#                           {'type':'started', 'id':..., 'pid':...}
+#                           {'type':'finished', 'id':..., 'returncode':...}
+#   coordinator -> worker : {'type':'run', 'id':..., 'cmd':..., 'cwd':..., 'env':{...}, 'nice':...}
+#                           {'type':'kill', 'id':...}
+#
+# Example (several workers on one box):
+#   o2_dpg_workflow_worker.py --listen unix:/tmp/worker1.sock --cpu 4 &
+#   o2_dpg_workflow_worker.py --listen unix:/tmp/worker2.sock --cpu 4 &
+#   o2_dpg_workflow_runner.py -f workflow.json --workers unix:/tmp/worker1.sock,unix:/tmp/worker2.sock
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import signal
+import socket
+import stat
+import subprocess
+import threading
+
+DEFAULT_TOKEN_FILE = '.o2dpg_worker_token'
+AUTH_TIMEOUT = 10 # seconds a connecting coordinator has to authenticate
+LAUNCH_FAILED = 127 # return code reported for tasks which could not be started
+
+# parses "unix:/path/to/socket" or "host:port" into (family, address)
+def parse_address(address):
+    if address.startswith('unix:'):
+        return (socket.AF_UNIX, address[len('unix:'):])
+    host, _, port = address.rpartition(':')
+    return (socket.AF_INET, (host if host != '' else '127.0.0.1', int(port)))
+
+# reads the shared secret; the file must not be accessible by group or others
+def read_token(filename):
+    st = os.stat(filename)
+    if st.st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+        raise PermissionError('token file ' + filename + ' must only be accessible by its owner (chmod 600)')
+    with open(filename) as fp:
+        token = fp.read().strip()
+    if len(token) == 0:
+        raise ValueError('token file ' + filename + ' is empty')
+    return token
+
+# creates a token file with a random secret (if it does not exist yet) and returns the secret;
+# the file appears atomically so that concurrently starting workers agree on one token
+def create_token(filename):
+    if not os.path.exists(filename):
+        tmpname = filename + '.' + socket.gethostname() + '.' + str(os.getpid())
+        fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(secrets.token_hex(32) + '\n')
+        try:
+            os.link(tmpname, filename)
+        except FileExistsError:
+            pass
+        os.remove(tmpname)
+    return read_token(filename)
+
+def auth_digest(token, nonce):
+    return hmac.new(token.encode(), nonce.encode(), hashlib.sha256).hexdigest()
+
+def connect(address):
+    family, addr = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(addr)
+    return sock
+
+def send_message(sock, lock, message):
+    data = (json.dumps(message) + '\n').encode()
+    with lock:
+        sock.sendall(data)
+
+# yields the messages arriving on a socket until it is closed
+def read_messages(sock):
+    buffer = b''
+    while True:
+        data = sock.recv(65536)
+        if len(data) == 0:
+            return
+        buffer += data
+        while b'\n' in buffer:
+            line, buffer = buffer.split(b'\n', 1)
+            if len(line) > 0:
+                yield json.loads(line)
+
+
+class Worker:
+    def __init__(self, cpu, mem, token):
+        self.cpu = cpu
+        self.mem = mem
+        self.token = token
+        self.tasks = {} # task id -> Popen
+        self.lock = threading.Lock() # serializes writes to the coordinator socket
+
+    # challenge-response with the shared token; True if the peer knows it
+    def authenticate(self, sock, messages):
+        nonce = secrets.token_hex(32)
+        sock.settimeout(AUTH_TIMEOUT)
+        try:
+            send_message(sock, self.lock, {'type':'challenge', 'nonce':nonce})
+            message = next(messages)
+        except (OSError, ValueError, StopIteration):
+            return False
+        sock.settimeout(None)
+        return message.get('type') == 'auth' and hmac.compare_digest(str(message.get('digest')), auth_digest(self.token, nonce))
+
+    # serves one coordinator connection until it closes
+    def serve(self, sock):
+        messages = read_messages(sock)
+        if not self.authenticate(sock, messages):
+            print ('Rejecting connection: authentication failed')
+            return
+        send_message(sock, self.lock, {'type':'hello', 'host':socket.gethostname(), 'cpu':self.cpu, 'mem':self.mem})
+        try:
+            for message in messages:
+                if message['type'] == 'run':
+                    self.run(sock, message)
+                elif message['type'] == 'kill':
+                    self.kill(message['id'])
+        except (OSError, ValueError) as e:
+            print ('Connection to coordinator lost: ' + str(e))
+        # without coordinator nobody will collect the results
+        for tid in list(self.tasks.keys()):
+            self.kill(tid)
+
+    def run(self, sock, message):
+        tid = message['id']
+        try:
+            env = os.environ.copy()
+            env.update({ k:str(v) for k, v in message.get('env', {}).items() })
+            nice = int(message.get('nice', 0)) - os.nice(0)
+            workdir = message['cwd']
+            if not os.path.isdir(workdir):
+                os.makedirs(workdir, exist_ok=True)
+            # own process group so that the whole task tree can be killed
+            p = subprocess.Popen(['/bin/bash', '-c', message['cmd']], cwd=workdir, env=env, start_new_session=True,
+                                 preexec_fn=(lambda: os.nice(nice)) if nice > 0 else None)
+        except (OSError, ValueError, TypeError, KeyError, subprocess.SubprocessError) as e:
+            # only this task failed; the connection and the other tasks are fine
+            print ('Cannot launch task ' + str(tid) + ': ' + str(e))
+            send_message(sock, self.lock, {'type':'finished', 'id':tid, 'returncode':LAUNCH_FAILED})
+            return
+        self.tasks[tid] = p
+        send_message(sock, self.lock, {'type':'started', 'id':tid, 'pid':p.pid})
+        threading.Thread(target=self.wait_for_task, args=(sock, tid, p), daemon=True).start()
+
+    def wait_for_task(self, sock, tid, p):
+        returncode = p.wait()
+        self.tasks.pop(tid, None)
+        try:
+            send_message(sock, self.lock, {'type':'finished', 'id':tid, 'returncode':returncode})
+        except OSError:
+            pass
+
+    def kill(self, tid):
+        p = self.tasks.get(tid)
+        if p == None:
+            return
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+def total_memory_mb():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024. / 1024.
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Worker agent executing tasks for a o2_dpg_workflow_runner.py coordinator.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--listen', help='Address to listen on: unix:/path/to/socket or host:port (port only: loopback). \
+                        Anyone able to connect and knowing the token can run commands as you.', required=True)
+    parser.add_argument('--token-file', help='File with the secret shared with the coordinator (created with a random token if missing).', default=DEFAULT_TOKEN_FILE)
+    parser.add_argument('--cpu', help='CPU cores offered to the coordinator', default=len(os.sched_getaffinity(0)))
+    parser.add_argument('--mem', help='Memory (MB) offered to the coordinator', default=int(total_memory_mb()))
+    args = parser.parse_args()
+
+    token = create_token(args.token_file)
+    family, addr = parse_address(args.listen)
+    if family == socket.AF_UNIX and os.path.exists(addr):
+        os.remove(addr)
+    server = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_INET:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # the unix socket is only accessible by the owner
+    umask = os.umask(0o077)
+    server.bind(addr)
+    os.umask(umask)
+    server.listen(1)
+    print ('Worker listening on ' + str(addr) + ' offering cpu ' + str(args.cpu) + ' mem ' + str(args.mem))
+
+    worker = Worker(float(args.cpu), float(args.mem), token)
+    while True:
+        conn, peer = server.accept()
+        print ('Coordinator connected')
+        worker.serve(conn)
+        conn.close()
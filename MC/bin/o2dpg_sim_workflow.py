@@ -106,6 +106,9 @@ def getDPL_global_options(bigshm=False,nosmallrate=False):
    else:
       return "-b --run --session " + str(taskcounter) + ' --driver-client-backend ws://' + (' --rate 1000','')[nosmallrate]
 
+# transient grid failures of alien.py copies are retried by the workflow runner
+ALIEN_RETRY={ 'max_attempts' : 3, 'backoff' : 30, 'backoff_factor' : 2 }
+
 doembedding=True if args.embedding=='True' or args.embedding==True else False
 usebkgcache=args.use_bkg_from!=None
 
@@ -117,6 +120,7 @@ if doembedding:
         INIBKG=args.iniBkg
         BKGtask=createTask(name='bkgsim', lab=["GEANT"], cpu='8')
         BKGtask['cmd']='o2-sim -e ' + SIMENGINE + ' -j ' + str(NWORKERS) + ' -n ' + str(NBKGEVENTS) + ' -g  ' + str(GENBKG) + ' ' + str(MODULES) + ' -o bkg --configFile ' + str(INIBKG)
+        BKGtask['inputs']=[ INIBKG ]
         workflow['stages'].append(BKGtask)
 
         # check if we should upload background event
@@ -124,6 +128,7 @@ if doembedding:
             BKGuploadtask=createTask(name='bkgupload', needs=[BKGtask['name']], cpu='0')
             BKGuploadtask['cmd']='alien.py mkdir ' + args.upload_bkg_to + ';'
             BKGuploadtask['cmd']+='alien.py cp -f bkg* ' + args.upload_bkg_to + ';'
+            BKGuploadtask['retry']=ALIEN_RETRY
             workflow['stages'].append(BKGuploadtask)
 
     else:
@@ -134,14 +139,15 @@ if doembedding:
         # 1: --> download bkg_MCHeader.root + grp + geometry
         # 2: --> download bkg_Hit files (individually)
         # 3: --> download bkg_Kinematics
-        # (A problem with individual copying might be higher error probability but
-        #  we can introduce a "retry" feature in the copy process)
+        # (A problem with individual copying might be higher error probability;
+        #  the copy tasks are therefore retried by the runner --> ALIEN_RETRY)
 
         # Step 1: header and link files
         BKG_HEADER_task=createTask(name='bkgdownloadheader', cpu='0', lab=['BKGCACHE'])
         BKG_HEADER_task['cmd']='alien.py cp ' + args.use_bkg_from + 'bkg_MCHeader.root .'
         BKG_HEADER_task['cmd']=BKG_HEADER_task['cmd'] + ';alien.py cp ' + args.use_bkg_from + 'bkg_geometry.root .'
         BKG_HEADER_task['cmd']=BKG_HEADER_task['cmd'] + ';alien.py cp ' + args.use_bkg_from + 'bkg_grp.root .'
+        BKG_HEADER_task['retry']=ALIEN_RETRY
         workflow['stages'].append(BKG_HEADER_task)
 
 # a list of smaller sensors (used to construct digitization tasks in a parametrized way)
@@ -152,6 +158,7 @@ for det in [ 'TPC', 'TRD' ] + smallsensorlist:
    if usebkgcache:
       BKG_HITDOWNLOADER_TASKS[det] = createTask(str(det) + 'hitdownload', cpu='0', lab=['BKGCACHE'])
       BKG_HITDOWNLOADER_TASKS[det]['cmd'] = 'alien.py cp ' + args.use_bkg_from + 'bkg_Hits' + str(det) + '.root .'
+      BKG_HITDOWNLOADER_TASKS[det]['retry'] = ALIEN_RETRY
       workflow['stages'].append(BKG_HITDOWNLOADER_TASKS[det])
    else:
       BKG_HITDOWNLOADER_TASKS[det] = None
@@ -159,6 +166,7 @@ for det in [ 'TPC', 'TRD' ] + smallsensorlist:
 if usebkgcache:
    BKG_KINEDOWNLOADER_TASK = createTask(name='bkgkinedownload', cpu='0', lab=['BKGCACHE'])
    BKG_KINEDOWNLOADER_TASK['cmd'] = 'alien.py cp ' + args.use_bkg_from + 'bkg_Kine.root .'
+   BKG_KINEDOWNLOADER_TASK['retry'] = ALIEN_RETRY
    workflow['stages'].append(BKG_KINEDOWNLOADER_TASK)
 
 # loop over timeframes
@@ -282,6 +290,7 @@ for tf in range(1, NTIMEFRAMES + 1):
 	              --ptHatMax=' + str(PTHATMAX)
       if WEIGHTPOW   > -1:
             SGN_CONFIG_task['cmd'] = SGN_CONFIG_task['cmd'] + ' --weightPow=' + str(WEIGHTPOW)
+      SGN_CONFIG_task['outputs'] = [ 'pythia8.cfg' ]
       workflow['stages'].append(SGN_CONFIG_task) 
    # elif GENERATOR == 'extgen': what do we do if generator is not pythia8?
        # NOTE: Generator setup might be handled in a different file or different files (one per
@@ -302,6 +311,8 @@ for tf in range(1, NTIMEFRAMES + 1):
    SGNtask['cmd']='o2-sim -e ' + str(SIMENGINE) + ' ' + str(MODULES) + ' -n ' + str(NSIGEVENTS) +  ' -j ' \
                   + str(NWORKERS) + ' -g ' + str(GENERATOR) + ' ' + str(TRIGGER)+ ' ' + str(CONFKEY) \
                   + ' ' + str(INIFILE) + ' -o ' + signalprefix + ' ' + embeddinto
+   if args.ini != '':
+      SGNtask['inputs'] = [ args.ini ]
    workflow['stages'].append(SGNtask)
 
    # some tasks further below still want geometry + grp in fixed names, so we provide it here
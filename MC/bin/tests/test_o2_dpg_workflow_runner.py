@@ -0,0 +1,105 @@
+# Regression tests for o2_dpg_workflow_runner.py. The runner is executed as a
+# subprocess on small synthetic workflows (it parses its arguments at import time).
+#
+#   python -m pytest MC/bin/tests
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+RUNNER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'o2_dpg_workflow_runner.py')
+
+def make_task(name, cmd, needs=[], cpu=1, mem=10, tf=-1):
+    return { 'name':name, 'cmd':cmd, 'needs':needs, 'resources':{ 'cpu':cpu, 'mem':mem }, 'timeframe':tf, 'labels':[], 'cwd':'./' }
+
+def run_workflow(workdir, stages, options=[], timeout=60):
+    with open(os.path.join(workdir, 'workflow.json'), 'w') as fp:
+        json.dump({ 'stages':stages }, fp)
+    return subprocess.run([ sys.executable, RUNNER, '-f', 'workflow.json', '--no-dag-cache' ] + options, cwd=workdir,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout)
+
+def test_keep_going_last_task_fails(tmp_path):
+    # the only (hence last) running task fails while the runner waits for it: the runner
+    # has to stop instead of waiting forever
+    result = run_workflow(tmp_path, [ make_task('a', 'sleep 0.3; exit 1') ], ['--keep-going'], timeout=30)
+    assert result.returncode == 1
+    assert b"Failed tasks:                    ['a']" in result.stdout
+
+def test_keep_going_poisons_dependents_only(tmp_path):
+    stages = [ make_task('a', 'exit 1'), make_task('b', 'touch b.ran', needs=['a']), make_task('c', 'sleep 0.5; touch c.ran') ]
+    result = run_workflow(tmp_path, stages, ['--keep-going'], timeout=30)
+    assert result.returncode == 1
+    assert b"Not run (depend on failed task): ['b']" in result.stdout
+    assert not os.path.exists(os.path.join(tmp_path, 'b.ran'))
+    assert os.path.exists(os.path.join(tmp_path, 'c.ran'))
+
+def test_worker_launch_error_fails_only_that_task(tmp_path):
+    # a task which cannot be launched (NUL byte in its environment) must not take down the other tasks of the worker
+    worker = subprocess.Popen([ sys.executable, os.path.join(os.path.dirname(RUNNER), 'o2_dpg_workflow_worker.py'), '--listen', 'unix:w.sock', '--cpu', '4' ],
+                              cwd=tmp_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for i in range(100):
+            if os.path.exists(os.path.join(tmp_path, 'w.sock')):
+                break
+            time.sleep(0.05)
+        bad = make_task('bad', 'true', tf=2)
+        bad['env'] = { 'X':'a\0b' }
+        stages = [ make_task('good', 'sleep 1; touch good.ran', tf=1), bad ]
+        result = run_workflow(tmp_path, stages, ['--keep-going', '--workers', 'unix:' + os.path.join(tmp_path, 'w.sock')], timeout=30)
+        assert result.returncode == 1
+        assert b"Failed tasks:                    ['bad']" in result.stdout
+        assert os.path.exists(os.path.join(tmp_path, 'good.ran'))
+    finally:
+        worker.kill()
+        worker.wait()
+
+def test_shards_run_global_tasks_once(tmp_path):
+    # bkgupload needs only global tasks: exactly one shard runs it; merge needs the timeframes of all shards
+    def task(name, needs, tf):
+        t = make_task(name, 'echo x >> ' + str(tmp_path) + '/ran_' + name + '; touch ' + name + '.log_done', needs=needs, tf=tf)
+        t['cwd'] = 'tf' + str(tf) if tf > 0 else './'
+        return t
+    stages = [ task('bkgsim', [], -1), task('bkgupload', ['bkgsim'], -1) ]
+    stages += [ task('sgn_' + str(tf), ['bkgsim'], tf) for tf in range(1, 5) ]
+    stages.append(task('merge', [ 'sgn_' + str(tf) for tf in range(1, 5) ], -1))
+    with open(os.path.join(tmp_path, 'workflow.json'), 'w') as fp:
+        json.dump({ 'stages':stages }, fp)
+    shards = [ subprocess.Popen([ sys.executable, RUNNER, '-f', 'workflow.json', '--no-dag-cache', '--shard', str(s) + '/2' ], cwd=tmp_path,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT) for s in range(2) ]
+    outputs = [ p.communicate(timeout=60)[0] for p in shards ]
+    assert all(p.returncode == 0 for p in shards)
+    for name in [ 'bkgsim', 'bkgupload', 'sgn_1', 'sgn_2', 'sgn_3', 'sgn_4' ]:
+        with open(os.path.join(tmp_path, 'ran_' + name)) as fp:
+            assert len(fp.readlines()) == 1
+    assert not os.path.exists(os.path.join(tmp_path, 'ran_merge'))
+    assert all(b"need timeframes of other shards (run them without --shard afterwards): ['merge']" in o for o in outputs)
+
+def test_cpu_affinity_does_not_pin_tasks_without_cpu(tmp_path):
+    # a cpu=0 task must not take a core: the task asking for all cores is still pinned next to it
+    ncores = len(os.sched_getaffinity(0))
+    stages = [ make_task('download', 'echo "[$O2DPG_TASK_CPUSET]" > download.cpuset; sleep 1', cpu=0),
+               make_task('sim', 'sleep 0.3; echo "[$O2DPG_TASK_CPUSET]" > sim.cpuset', cpu=ncores) ]
+    result = run_workflow(tmp_path, stages, ['--cpu-affinity', '--cpu-limit', str(ncores)])
+    assert result.returncode == 0
+    with open(os.path.join(tmp_path, 'download.cpuset')) as fp:
+        assert fp.read().strip() == '[]'
+    with open(os.path.join(tmp_path, 'sim.cpuset')) as fp:
+        assert fp.read().strip() != '[]'
+
+def test_locked_resource_history_does_not_abort(tmp_path):
+    # the history database gets locked by somebody else while the workflow runs
+    db = os.path.join(tmp_path, 'history.db')
+    locker = subprocess.Popen([ sys.executable, '-c', 'import sqlite3, sys, time\n'
+                                'c = sqlite3.connect(sys.argv[1]); c.execute("CREATE TABLE IF NOT EXISTS t (x)"); c.commit()\n'
+                                'time.sleep(1); c.execute("BEGIN EXCLUSIVE"); time.sleep(15)', db ])
+    try:
+        result = run_workflow(tmp_path, [ make_task('a', 'sleep 2') ], ['--resource-history', db])
+    finally:
+        locker.kill()
+        locker.wait()
+    assert result.returncode == 0
+    assert b'Traceback' not in result.stdout
+    with open(os.path.join(tmp_path, 'pipeline_action.log')) as fp:
+        assert 'Resource history disabled after database error: database is locked' in fp.read()